@@ -5,24 +5,33 @@ import pandas as pd
 from tabulate import tabulate
 import matplotlib.pyplot as plt  
 from numpy.random import seed #to set random seed
-from sklearn import decomposition
-from sklearn.metrics import confusion_matrix
-from sklearn.metrics import accuracy_score
-from sklearn.metrics import log_loss
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.naive_bayes import MultinomialNB
 from keras.utils import to_categorical
-from keras.layers import Activation, Convolution2D, Dense, Dropout, Flatten, MaxPooling2D
+from keras.layers import Activation, Convolution2D, Dense, Dropout, Flatten, MaxPooling2D, Rescaling
 from keras.models import Sequential
 from keras.layers import Input
 from keras.models import Model
-from keras.preprocessing.image import ImageDataGenerator
-from keras.applications.xception import preprocess_input
 from keras.callbacks import EarlyStopping
 from keras.callbacks import TensorBoard
 from keras.callbacks import ModelCheckpoint
 from keras.models import load_model
 from keras import backend as K
+from dataset_cache import DatasetCache
+from label_map import build_label_map, apply_label_map
+from decomposition_compare import DecompositionComparison
+from group_stats import GroupedStats
+from flat_models import fit_flat_model, run_flat_grid, sweep_forest
+from input_pipeline import make_dataset, make_balanced_dataset, preprocess, to_float32, preprocess_images
+from splits import ImageView, usage_indices, BalancedBatchSampler
+from process_scheduler import run_with_thread_budgets
+from cnn_search import SuccessiveHalving, sample_configs
+from stages import StageGraph
+from evaluation import Evaluation, evaluate_model
+from telemetry import TrainingTelemetry, GradientHistograms
+from checkpointing import BestWeightsCheckpoint
+import simple_cnn
+import tensorflow as tf
 print(K.image_data_format()) #
 K.set_image_data_format('channels_last') # set format
 print(K.image_data_format()) #
@@ -33,6 +42,9 @@ from tensorflow.compat.v1 import InteractiveSession
 
 config = ConfigProto()
 config.gpu_options.allow_growth = True
+# thread budgets set by process_scheduler for concurrent training workers (0 = TF default)
+config.intra_op_parallelism_threads = int(os.environ.get('TF_NUM_INTRAOP_THREADS', 0))
+config.inter_op_parallelism_threads = int(os.environ.get('TF_NUM_INTEROP_THREADS', 0))
 session = InteractiveSession(config=config)
 
 
@@ -46,8 +58,10 @@ class EmotionFaceClassifier():
         self.cv2_path = cv2_path # where face processing files can be found (from cv2)
         self.df_path = df_path # where train images live
         self.df_csv = ''.join([df_path, '.csv']) # csv file with data
-        self.df_output_pkl = ''.join([df_path,'_ouput.pkl']) # pickled output file
-        self.df_output_csv = ''.join([df_path,'_ouput.csv']) # csv output file
+        self.cache_dir = ''.join([df_path, '_cache']) # processed data cache (see dataset_cache.DatasetCache)
+        self.cache_max_bytes = 10 * 1024**3 # disk budget for the cache, least recently used entries are evicted
+        self.extra_csvs = [] # extra labelled face csvs (fer2013.csv columns) merged after df_csv
+        self.stage_dir = ''.join([df_path, '_stages']) # cached outputs of run_analysis stages (see build_stages)
         self.emo_dict = {0:'Angry', 
                         1: 'Disgust', 
                         2: 'Fear', 
@@ -56,14 +70,22 @@ class EmotionFaceClassifier():
                         5: 'Surprise', 
                         6: 'Neutral'} # condiiton dict
         self.emo_list = list(self.emo_dict.values()) # labels 
+        self.source_emo_dict = dict(self.emo_dict) # classes of the csv labels, what remap_labels always maps from
+        self.label_spec = {'drop': ['Disgust']} # classes to drop/merge before modeling (see remap_labels)
         self.results_df = pd.DataFrame() # df for storing model results (empty for now)
         self.n_components=10 # components for PCA, NMF
         self.n_trees = 500 # tress for RF
         self.seed_val = 1 # Seed val for random state
         self.values=[1, 3, 5, 10] # values to examine for PCA, NMF
+        self.n_jobs = os.cpu_count() # worker processes for parallel model fits
+        self.decomp_batch_size = None # rows per batch for out-of-core IncrementalPCA/MiniBatchNMF (None = in memory)
         self.flat_models = [MultinomialNB, RandomForestClassifier] # non CNN models to fit
         self.flat_model_names = ['MNB', 'Random_forest'] # Names of models
         self.flat_models_bal = [True, False] # True=run balanced datasets, False=run unbalanced
+        self.flat_model_params = {'Random_forest': {'n_estimators': self.n_trees,
+                                                    'random_state': self.seed_val}} # kwargs by model name
+        self.forest_checkpoints = [50, 100, 200, 500] # tree counts for sweep_random_forest
+        self.forest_min_gain = 0.005 # stop the sweep when val log loss improves less than this
         # params for keras model
         self.nb_filters = 72
         self.kernel_size = (4, 4)
@@ -72,97 +94,189 @@ class EmotionFaceClassifier():
         self.batch_size = 512 # n of images to processed in each keras batch
         self.n_epochs = 100 # number of keras epochs
         self.input_size = (48,48,1)
+        self.cnn_variants = [('CNN_cat', False, True),
+                             ('CNN_cat_bal', True, True),
+                             ('CNN_cont', False, False),
+                             ('CNN_cont_bal', True, False)] # (model_name, balanced, categorical)
+        self.cnn_workers = len(self.cnn_variants) # concurrent CNN training processes (1 = sequential, in process)
+        # successive-halving search over CNN settings (see search_cnn)
+        self.search_space = {'builder': ['create_model', 'simple_cnn.create_model', 'simple_cnn.create_model2',
+                                         'simple_cnn.create_model3', 'simple_cnn.create_model4'],
+                             'nb_filters': [32, 48, 72, 96],
+                             'kernel_size': [(2, 2), (3, 3), (4, 4)],
+                             'batch_size': [128, 256, 512],
+                             'steps_per_epoch': [25, 50]}
+        # settings only some builders use (simple_cnn models fix their own filters and kernels)
+        self.search_conditions = {'nb_filters': {'builder': ['create_model']},
+                                  'kernel_size': {'builder': ['create_model']}}
+        self.search_n_configs = 27
+        self.search_min_epochs = 1 # epochs per config in the first rung
+        self.search_max_epochs = 27 # epochs for the final survivors
+        self.search_eta = 3 # keep the best 1/eta each rung
+        # how CNN inputs are stored: 'float32' preprocess_input each epoch (cached in RAM after the first),
+        # 'float16' preprocessed once into the dataset cache, 'uint8' raw with scaling fused into the model
+        self.input_dtype = 'float32'
+        # TensorBoard: None (off), 'scalars' (epoch metrics only) or 'sampled' (adds graph, weight histograms
+        # and images, plus gradient histograms of a validation batch from telemetry.GradientHistograms, every
+        # tensorboard_sample_every epochs); telemetry.csv/json are always written
+        self.tensorboard_mode = 'scalars'
+        self.tensorboard_sample_every = 10
+        # best-model checkpoints: 'memory' keeps the best weights in memory and writes them on a background
+        # thread, 'disk' is ModelCheckpoint writing synchronously and reloading the file for evaluation
+        self.checkpoint_mode = 'memory'
+        self.eval_batch_size = 1024 # images per forward pass when evaluating trained CNNs
+        self.eval_keep_proba = True # False streams evaluation keeping only classes and totals (low memory)
         self.validation_steps = 50
         self.steps_per_epoch = 50
+        self.ingest_chunk_size = 4096 # csv rows read and decoded per chunk
 
 
-    def run_analysis(self):
-        self.load_data() 
-        self.save_df()
-        self.drop_disgust() # disgust has far fewer imgs than other emos, so dropping to improve model performance
-        self.plot_example_images() # creates ../images/example_imgs.png (1 img of each emotion)
-        self.split_x_y() # create train/validate/test splits on data
-        self.balanced_split_x_y() # create balanced train/validate/test splits on data
-        self.table_of_data() # table showing img count by emotion types (bal and unbal)         
+    def run_analysis(self, targets=None, force=()):
+        '''
+        Runs the stages of build_stages. Stages whose inputs are unchanged
+        since an earlier run are restored from self.stage_dir instead of
+        recomputed, so a rerun after a crash picks up where it stopped
+
+        Args:
+            targets (list of str): stages to bring up to date, with what they depend on (None = all)
+            force (list of str): stages to rerun even if cached
+            '''
+        self.results_df = pd.DataFrame()
+        self.build_stages().run(targets, force)
+
+    def run_stage(self, name, force=False):
+        # bring a single stage (and what it depends on) up to date, e.g. run_stage('CNN_cat_bal')
+        self.run_analysis([name], force=[name] if force else ())
+
+    def build_stages(self):
+        '''
+        Stage graph of the analysis, in run order. Data stages are not cached
+        (the dataset cache already makes them cheap) and only run when a
+        stage that has to execute needs them
+        '''
+        graph = StageGraph(self.stage_dir, apply=self.apply_stage)
+        csvs = [self.df_csv] + self.extra_csvs
+        graph.add('load', self.load_data, cache=False,
+                  params=lambda: {'source': DatasetCache(self.cache_dir).source_key(csvs)})
+        # by default drops disgust (far fewer imgs than other emos) to improve model performance
+        graph.add('labels', lambda: self.remap_labels(self.label_spec), deps=['load'], cache=False,
+                  params={'label_spec': self.label_spec})
+        # creates ../images/example_imgs.png (1 img of each emotion)
+        graph.add('example_images', self.plot_example_images, deps=['labels'],
+                  params={'seed': self.seed_val}, files=['../images/example_imgs.png'])
+        graph.add('splits', self.split_x_y, deps=['labels'], cache=False) # create train/validate/test splits on data
+        graph.add('balance', self.balanced_split_x_y, deps=['splits'], cache=False,
+                  params={'seed': self.seed_val, 'sampling': 'balanced_batches'}) # create balanced train/validate/test splits on data
+        graph.add('table', self.table_of_data, deps=['balance'], cache=False) # img count by emotion types (bal and unbal)
         # self.pca_analysis() # creates ../images/pca_images.png (mean face by emo type)
         # self.pca_analysis_comparison() # uses self.values to examine PCA components by emotion type
-        # self.nmf_analysis_comparison() # uses self.values to examine NMF components by emotion type       
-        # ## Iterates over flat models and balance type, appends results to self.results_df
-        for mdl, name in zip(self.flat_models, self.flat_model_names):
-            for opt in self.flat_models_bal:
-                self.run_flat_model(mdl, name, balanced=opt)
-        self.run_cnn(model_name='CNN_cat', balanced=False, categorical=True)
-        self.run_cnn(model_name='CNN_cat_bal', balanced=True, categorical=True)
-        self.run_cnn(model_name='CNN_cont', balanced=False, categorical=False)
-        self.run_cnn(model_name='CNN_cont_bal', balanced=True, categorical=False)
-        self.format_results_df() # Show results in pretty format
+        # self.nmf_analysis_comparison() # uses self.values to examine NMF components by emotion type
+        # ## Fits flat models x balance type concurrently, one stage (results row + cm png) per pair
+        model_stages = []
+        for mdl, name, balanced in self.flat_model_grid():
+            stage = self.flat_stage_name(name, balanced)
+            graph.add(stage, None, deps=['balance'], group='flat', files=['../images/'+stage+'.png'],
+                      params={'model': name, 'balanced': balanced, 'params': self.flat_model_params.get(name, {})})
+            model_stages.append(stage)
+        graph.add_group('flat', self.run_flat_stages)
+        # self.sweep_random_forest() # warm-start RF tree-count sweep, one results row per checkpoint
+        # self.search_cnn() # successive-halving search over CNN settings, creates ../images/cnn_search.csv
+        # trains self.cnn_variants concurrently, one stage (results row, cm png, best model) per variant
+        cnn_params = {k: getattr(self, k) for k in ['nb_filters', 'kernel_size', 'pool_size', 'batch_size',
+                                                     'n_epochs', 'input_size', 'input_dtype',
+                                                     'validation_steps', 'steps_per_epoch']}
+        for variant in self.cnn_variants:
+            model_name = variant[0]
+            graph.add(model_name, None, deps=['balance'], group='cnn',
+                      params=dict(cnn_params, variant=variant),
+                      files=['../images/'+model_name+'.png', model_name+'.hdf5',
+                             model_name+'/telemetry.json', model_name+'/telemetry.csv'])
+            model_stages.append(model_name)
+        graph.add_group('cnn', self.run_cnn_stages)
+        graph.add('results', self.format_results_df, deps=model_stages, cache=False) # Show results in pretty format
+        return graph
+
+    def apply_stage(self, name, outputs):
+        # model stages output their rows of self.results_df, appended in stage order
+        if 'results' in outputs:
+            self.append_result(outputs['results'].iloc[0]) # one-row frame from take_results
+
+    def take_results(self, names, start):
+        # results rows appended since start (one per stage name), handed to the stage graph to apply
+        rows = self.results_df.iloc[start:]
+        self.results_df = self.results_df.iloc[:start]
+        return {name: {'results': rows.iloc[[i]]} for i, name in enumerate(names)}
+
+    @staticmethod
+    def flat_stage_name(model_name, balanced):
+        return model_name + ('_balanced' if balanced else '_not_balanced')
+
+    def run_flat_stages(self, names):
+        grid = [spec for spec in self.flat_model_grid() if self.flat_stage_name(*spec[1:]) in names]
+        start = len(self.results_df)
+        self.run_flat_models(grid)
+        return self.take_results([self.flat_stage_name(*spec[1:]) for spec in grid], start)
+
+    def run_cnn_stages(self, names):
+        variants = [variant for variant in self.cnn_variants if variant[0] in names]
+        start = len(self.results_df)
+        self.run_cnns(variants)
+        return self.take_results([variant[0] for variant in variants], start)
 
     def load_data(self):
         '''
-        Will load and process data from self.df_csv if no
-        processed data is found (i.e., self.df_output_csv does not exist)
+        Will stream and process data from self.df_csv (plus self.extra_csvs)
+        into self.cache_dir if no processed data is found for the current
+        contents of those files, then open it
+
+        self.images is the memory-mapped image array, self.df holds the
+        'emotion' and 'Usage' columns; the index of self.df is the row
+        position in self.images
         '''
         print(f'Loading data...')
-        if not os.path.isfile(self.df_output_pkl):
-            self.df = pd.read_csv(self.df_csv)
-            print(f'Converting strings to arrays')
-            self.gen_arrays()
-        else:
-            print(f'Processed data found...')
-            print(f'Loading data from {self.df_output_pkl}')            
-            self.df = pd.read_pickle(self.df_output_pkl)
+        self.cache = DatasetCache(self.cache_dir, max_bytes=self.cache_max_bytes)
+        self.images, self.df, _, self.source_key = self.cache.load_source([self.df_csv] + self.extra_csvs,
+                                                                          chunk_size=self.ingest_chunk_size)
+        self.source_df = self.df # labels as loaded, kept for remap_labels
 
-    def gen_arrays(self):
-        self.df['img_array']=self.df['pixels'].apply(self.convert_pixels_to_array)
+    def remap_labels(self, spec):
+        '''
+        Drop and/or merge classes (see label_map.build_label_map for the spec),
+        as one table lookup on the label column; updates emo_dict and emo_list
 
-    @staticmethod
-    def convert_pixels_to_array(pixels):
-        array = np.array([int(x) for x in pixels.split(' ')]).reshape(48,48)
-        array = np.array(array, dtype='uint8')
-        return array
-    
-    def save_df(self):
-        print(f'Saving data to {self.df_output_csv}')
-        self.df.to_csv(self.df_output_csv)
-        print(f'Saving data to {self.df_output_pkl}')
-        self.df.to_pickle(self.df_output_pkl)
+        Always maps the labels as loaded (source_df, source_emo_dict), so
+        calling it again (e.g. the labels stage of a second run) gives the
+        same result instead of remapping remapped labels
+        '''
+        lut, self.emo_dict = build_label_map(self.source_emo_dict, spec)
+        new_labels, keep = apply_label_map(self.source_df['emotion'].values, lut)
+        self.df = self.source_df[keep]
+        self.df['emotion'] = new_labels[keep]
+        self.emo_list = list(self.emo_dict.values()) # new list of class labels
 
     def drop_disgust(self):
         '''
         Disgust has far fewer imgs than other categories, dropping to reduce class imbalance
         '''
-        self.df = self.df[self.df['emotion']!=1] # 1 = Disgust
-        self.df['emotion'] = self.df.apply(self.drop_vals_over_1,axis=1) # reassigns class values accounting for drop
-        self.emo_dict = {0:'Angry', 1: 'Fear', 2:'Happy', 3: 'Sad', 4:'Surprise', 5: 'Neutral'} # new dict of output labels
-        self.emo_list = list(self.emo_dict.values()) # new list of class labels
-
-    @staticmethod
-    def drop_vals_over_1(row):
-        if row['emotion'] > 1:
-            return row['emotion'] -1
-        else:
-            return row['emotion']
+        self.remap_labels({'drop': ['Disgust']})
 
     def split_x_y(self):
-        # Split data into train, val, test
-        self.train_data = self.df[self.df['Usage']=='Training']
-        self.val_data = self.df[self.df['Usage']=='PublicTest']
-        self.test_data = self.df[self.df['Usage']=='PrivateTest']
-        # Conver data to np arrays
-        self.x_train = np.stack(self.train_data['img_array'].values)
-        self.y_train = np.stack(self.train_data['emotion'].values)
-        self.x_val = np.stack(self.val_data['img_array'].values)
-        self.y_val = np.stack(self.val_data['emotion'].values)
-        self.x_test = np.stack(self.test_data['img_array'].values)
-        self.y_test = np.stack(self.test_data['emotion'].values)
-        # For X arrays, create flattened (2d) versions of data
-        self.x_train_flat = self.x_train.reshape(self.x_train.shape[0],-1) 
-        self.x_val_flat = self.x_val.reshape(self.x_val.shape[0], -1)
-        self.x_test_flat = self.x_test.reshape(self.x_test.shape[0], -1)
-        # For X arrays, add axis for keras input (expects 3d arrays)
-        self.x_train = np.expand_dims(self.x_train, axis=3) 
-        self.x_val = np.expand_dims(self.x_val, axis=3)
-        self.x_test = np.expand_dims(self.x_test, axis=3) 
+        # Split data into train, val, test as row positions into self.images
+        self.train_idx = usage_indices(self.df, 'Training')
+        self.val_idx = usage_indices(self.df, 'PublicTest')
+        self.test_idx = usage_indices(self.df, 'PrivateTest')
+        labels = self.df['emotion']
+        self.y_train = labels.loc[self.train_idx].values
+        self.y_val = labels.loc[self.val_idx].values
+        self.y_test = labels.loc[self.test_idx].values
+        # X arrays are lazy views of the shared buffer, rows are only gathered when read
+        # channels_last (n, 48, 48, 1) for keras input, flat (n, 2304) for sklearn models
+        self.x_train = ImageView(self.images, self.train_idx, 'channels_last')
+        self.x_val = ImageView(self.images, self.val_idx, 'channels_last')
+        self.x_test = ImageView(self.images, self.test_idx, 'channels_last')
+        self.x_train_flat = self.x_train.flat()
+        self.x_val_flat = self.x_val.flat()
+        self.x_test_flat = self.x_test.flat()
         # Calculate number of classes
         self.n_classes = len(np.unique(self.y_train))
         # create OHE versions of Y
@@ -171,27 +285,22 @@ class EmotionFaceClassifier():
         self.y_test_cat = to_categorical(self.y_test, self.n_classes)
 
     def balanced_split_x_y(self):
-        # create balanced versions of data, equal to lowest N by category
-        self.bal_df = self.train_data.groupby('emotion')
-        self.bal_df = self.bal_df.apply(lambda x: x.sample(self.bal_df.size().min(), random_state=self.seed_val).reset_index(drop=True))
-
-        self.bal_df = self.bal_df.reset_index(drop=True)
-
-        # parse x, y TRAINING data (test and val data don't change)
-        self.bal_x_train = np.stack(self.bal_df['img_array'].values)
-        self.bal_y_train = np.stack(self.bal_df['emotion'].values)
-        self.bal_x_train_flat = self.bal_x_train.reshape(self.bal_x_train.shape[0],-1) 
-        self.bal_x_train = np.expand_dims(self.bal_x_train, axis=3) 
-        self.bal_y_train_cat = to_categorical(self.bal_y_train, self.n_classes)
+        # class-balanced sampling of the whole training split, no balanced copy (test and val data don't change):
+        # balanced CNNs draw balanced batches on the fly, balanced flat models weight rows by expected draws
+        self.bal_sampler = BalancedBatchSampler(self.y_train, self.batch_size, seed=self.seed_val)
+        self.bal_sample_weight = self.bal_sampler.sample_weight()
 
     def table_of_data(self):
         x = pd.Series(self.emo_dict)
         self.data_df = x.to_frame()
         self.data_df.columns = ['Label']
-        self.data_df['# train']=self.train_data.groupby('emotion').size()
-        self.data_df['# bal train']=self.bal_df.groupby('emotion').size()
-        self.data_df['# validation']=self.val_data.groupby('emotion').size()
-        self.data_df['# test']=self.test_data.groupby('emotion').size()
+        n_labels = len(self.emo_dict)
+        self.data_df['# train']=np.bincount(self.y_train, minlength=n_labels)
+        bal_draws = np.zeros(n_labels)
+        bal_draws[self.bal_sampler.classes] = self.bal_sampler.class_draws()
+        self.data_df['# bal train']=bal_draws # expected draws per pass of the training split
+        self.data_df['# validation']=np.bincount(self.y_val, minlength=n_labels)
+        self.data_df['# test']=np.bincount(self.y_test, minlength=n_labels)
         self.to_markdown_with_index(self.data_df)
 
     @staticmethod
@@ -206,12 +315,15 @@ class EmotionFaceClassifier():
 
     def plot_example_images(self):  
         fig=plt.figure(figsize=(10, 3))
-        columns = 6
+        columns = len(self.emo_list)
         rows = 1
+        # first row of each emotion in a random order = one random example per emotion (seeded, the stage is keyed on seed_val)
+        shuffled = np.random.RandomState(self.seed_val).permutation(len(self.df))
+        _, first = np.unique(self.df['emotion'].values[shuffled], return_index=True)
+        examples = self.df.index.values[shuffled[first]]
         for i in range(1, columns*rows+1):
             emo_val = i-1
-            sel_img = self.df[self.df['emotion']==emo_val]['img_array'].sample(1)
-            img = np.hstack(sel_img)
+            img = self.images[examples[emo_val]]
             fig.add_subplot(rows, columns, i)
             plt.gca().set_title(self.emo_list[emo_val])
             plt.imshow(img, cmap='gray')
@@ -220,27 +332,29 @@ class EmotionFaceClassifier():
         # plt.show()
         plt.close()
 
+    def group_stats(self):
+        # per-emotion image statistics over all rows, and over the training rows
+        n_groups = len(self.emo_list)
+        self.emo_stats = GroupedStats.from_images(self.images, self.df.index.values,
+                                                  self.df['emotion'].values, n_groups)
+        self.train_stats = GroupedStats.from_images(self.images, self.train_idx, self.y_train, n_groups)
+
     def pca_analysis(self):
+        # mean face overall (training data) and by emotion
+        self.group_stats()
         fig=plt.figure(figsize=(10, 3))
         columns = self.n_classes+1
         rows = 1
-        self.pca = decomposition.PCA(n_components=self.n_components, whiten=True)
-        self.pca.fit(self.x_train_flat)
         fig.add_subplot(rows, columns, 1)
-        plt.imshow(self.pca.mean_.reshape(48, 48),
+        plt.imshow(self.train_stats.image(self.train_stats.total()[1]),
                    cmap=plt.cm.bone)
         plt.gca().set_title('Overall')
         plt.axis('off')
+        mean_faces = self.emo_stats.image(self.emo_stats.mean)
         for i in range(2, columns*rows+1):
             emo_val = i-2
-            t1 = self.df[self.df['emotion']==emo_val]
-            temp_x_train = np.stack(t1.pop('img_array').values)
-            temp_x_train_flat = temp_x_train.reshape(temp_x_train.shape[0],-1)
-            # print(temp_x_train_flat.shape) 
             fig.add_subplot(rows, columns, i)
-            pca = decomposition.PCA(n_components=self.n_components, whiten=True)
-            pca.fit(temp_x_train_flat)
-            plt.imshow(pca.mean_.reshape(48, 48),
+            plt.imshow(mean_faces[emo_val],
                    cmap=plt.cm.bone)
             plt.gca().set_title(self.emo_list[emo_val])
             plt.axis('off')
@@ -248,88 +362,98 @@ class EmotionFaceClassifier():
         # plt.show()
         plt.close()
 
+    def decomposition_groups(self):
+        # row positions for 'Overall' (training data) and each emotion (all splits)
+        groups = {'Overall': self.train_idx}
+        for emo_val, emo in enumerate(self.emo_list):
+            groups[emo] = self.df.index.values[(self.df['emotion']==emo_val).values]
+        return groups
+
     def pca_analysis_comparison(self):
         print('Running PCA component comparisons')
-        fig=plt.figure(figsize=(10, 2*len(self.values)))
-        columns = self.n_classes+1
-        rows = len(self.values)
-        for indx, val in enumerate(self.values):
-            # self.nmf = decomposition.NMF(n_components=val)
-            # self.nmf.fit(self.x_train_flat)
-            self.pca = decomposition.PCA(n_components=val, whiten=True)
-            self.pca.fit(self.x_train_flat)
-
-            fig.add_subplot(rows, columns, 1+(indx*columns))
-            plt.imshow(self.pca.components_.mean(0).reshape(48, 48),
-                   cmap=plt.cm.bone)
-            plt.gca().set_title('Overall')
-            plt.axis('off')
-            for emo_val, i in enumerate(range(2, columns+1)):
-                t1 = self.df[self.df['emotion']==emo_val]
-                temp_x_train = np.stack(t1.pop('img_array').values)
-                temp_x_train_flat = temp_x_train.reshape(temp_x_train.shape[0],-1)
-                # print(temp_x_train_flat.shape) 
-                fig.add_subplot(rows, columns, i+(indx*columns))
-                pca = decomposition.PCA(n_components=val)
-                pca.fit(temp_x_train_flat)
-                plt.imshow(pca.components_.mean(0).reshape(48, 48),
-                   cmap=plt.cm.bone)
-                plt.gca().set_title(self.emo_list[emo_val])
-                plt.axis('off')
-        plt.savefig('../images/pca_images_comparison.png')
-        # plt.show()
-        plt.close()
+        comparison = DecompositionComparison(self.images, self.decomposition_groups(), self.values,
+                                             seed=self.seed_val, batch_size=self.decomp_batch_size)
+        components = comparison.pca_components()
+        print(f"PCA fits took {comparison.timings['pca']:.1f}s")
+        self.plot_component_comparison(components, '../images/pca_images_comparison.png')
 
     def nmf_analysis_comparison(self):
         print('Running NMF component comparisons')
+        comparison = DecompositionComparison(self.images, self.decomposition_groups(), self.values,
+                                             n_jobs=self.n_jobs, seed=self.seed_val,
+                                             batch_size=self.decomp_batch_size)
+        components = comparison.nmf_components()
+        print(f"NMF fits took {comparison.timings['nmf']:.1f}s on {comparison.n_jobs} processes")
+        self.plot_component_comparison(components, '../images/nmf_images_comparison.png')
+
+    def plot_component_comparison(self, components, outfile):
+        # one row per component count, one column per group (Overall, then each emotion)
         fig=plt.figure(figsize=(10, 2*len(self.values)))
-        columns = self.n_classes+1
+        columns = len(components)
         rows = len(self.values)
         for indx, val in enumerate(self.values):
-            self.nmf = decomposition.NMF(n_components=val)
-            self.nmf.fit(self.x_train_flat)
-
-            fig.add_subplot(rows, columns, 1+(indx*columns))
-            plt.imshow(self.nmf.components_.mean(0).reshape(48, 48),
-                       cmap=plt.cm.bone)
-            plt.gca().set_title('Overall')
-            plt.axis('off')
-            for emo_val, i in enumerate(range(2, columns+1)):
-                t1 = self.df[self.df['emotion']==emo_val]
-                temp_x_train = np.stack(t1.pop('img_array').values)
-                temp_x_train_flat = temp_x_train.reshape(temp_x_train.shape[0],-1)
-                # print(temp_x_train_flat.shape) 
-                fig.add_subplot(rows, columns, i+(indx*columns))
-                nmf = decomposition.NMF(n_components=val)
-                nmf.fit(temp_x_train_flat)
-                plt.imshow(nmf.components_.mean(0).reshape(48, 48),
+            for i, (name, by_val) in enumerate(components.items()):
+                fig.add_subplot(rows, columns, 1+i+(indx*columns))
+                plt.imshow(by_val[val].reshape(48, 48),
                        cmap=plt.cm.bone)
-                plt.gca().set_title(self.emo_list[emo_val])
+                plt.gca().set_title(name)
                 plt.axis('off')
-        plt.savefig('../images/nmf_images_comparison.png')
+        plt.savefig(outfile)
         # plt.show()
         plt.close()
 
+    def flat_model_task(self, model, model_name, balanced=False):
+        # what a flat_models.fit_flat_model call needs: model, kwargs and row positions
+        return {'model': model,
+                'params': self.flat_model_params.get(model_name, {}),
+                'train_rows': self.train_idx,
+                'y_train': self.y_train,
+                'sample_weight': self.bal_sample_weight if balanced else None,
+                'test_rows': self.test_idx}
+
     def run_flat_model(self, model, model_name, balanced=False):
         print(f'Running model: {model_name}')
-        self.model = model()
-        if not balanced:
-            self.model.fit(self.x_train_flat, self.y_train)
-            self.train_pred_y = self.model.predict(self.x_train_flat)
-            self.train_pred_proba = self.model.predict_proba(self.x_train_flat)
-            fname = model_name+'_not_balanced'
-        else:
-            self.model.fit(self.bal_x_train_flat, self.bal_y_train)
-            self.train_pred_y = self.model.predict(self.bal_x_train_flat)
-            self.train_pred_proba = self.model.predict_proba(self.bal_x_train_flat)
-            fname = model_name+'_balanced'
-        self.test_pred_y = self.model.predict(self.x_test_flat)
-        self.test_pred_proba = self.model.predict_proba(self.x_test_flat)
-        self.save_cm(self.test_pred_y, fname)
-        self.update_results(model_name, balanced, self.train_pred_y, self.test_pred_y, self.train_pred_proba, self.test_pred_proba)
-
-    def save_cm(self, y_pred, output):
-        cnf_matrix = confusion_matrix(self.y_test, y_pred.T)
+        result = fit_flat_model(self.images, **self.flat_model_task(model, model_name, balanced))
+        self.record_flat_model(model_name, balanced, result)
+
+    def flat_model_grid(self):
+        # every (model, name, balanced) in self.flat_models x self.flat_models_bal
+        return [(mdl, name, opt) for mdl, name in zip(self.flat_models, self.flat_model_names)
+                for opt in self.flat_models_bal]
+
+    def run_flat_models(self, grid=None):
+        # (model, name, balanced) fits from grid (default: flat_model_grid) in worker processes
+        grid = self.flat_model_grid() if grid is None else grid
+        print(f'Running models: {[name for _, name, _ in grid]}')
+        results = run_flat_grid(self.images, [self.flat_model_task(*spec) for spec in grid], n_jobs=self.n_jobs)
+        for (_, name, opt), result in zip(grid, results): # merged in grid order
+            self.record_flat_model(name, opt, result)
+
+    def sweep_random_forest(self, balanced=False):
+        # grow a warm-started forest through self.forest_checkpoints, one results row per checkpoint
+        print(f'Sweeping Random_forest tree counts: {self.forest_checkpoints}')
+        task = self.flat_model_task(RandomForestClassifier, 'Random_forest', balanced)
+        params = {k: v for k, v in task['params'].items() if k != 'n_estimators'}
+        curve = sweep_forest(self.images, params, task['train_rows'], task['y_train'],
+                             self.val_idx, self.y_val, self.test_idx, self.y_test,
+                             checkpoints=self.forest_checkpoints, min_gain=self.forest_min_gain,
+                             sample_weight=task['sample_weight'], n_jobs=self.n_jobs)
+        for point in curve:
+            result_ser = pd.Series(point)
+            result_ser['Model'] = 'Random_forest_' + str(point['Trees'])
+            result_ser['Balanced'] = balanced
+            self.append_result(result_ser)
+        self.format_results_df()
+
+    def record_flat_model(self, model_name, balanced, result):
+        self.train_pred_y, self.train_pred_proba, self.test_pred_y, self.test_pred_proba = result
+        self.train_eval = Evaluation.from_proba(self.y_train, self.train_pred_proba)
+        self.test_eval = Evaluation.from_proba(self.y_test, self.test_pred_proba)
+        self.save_cm(self.test_eval.confusion, self.flat_stage_name(model_name, balanced))
+        self.update_results(model_name, balanced, self.train_eval, self.test_eval)
+
+    def save_cm(self, cnf_matrix, output):
+        # test-set confusion matrix (see evaluation.Evaluation)
         # Plot normalized confusion matrix
         plt.figure()
         self.plot_confusion_matrix(cnf_matrix, classes=self.emo_list, normalize=True,
@@ -370,47 +494,55 @@ class EmotionFaceClassifier():
         plt.xlabel('Predicted label')
         plt.tight_layout()
 
-    def update_results(self, model, balanced, pred_train_y, pred_test_y, train_pred_proba, test_pred_probas):
-        self.train_results = pred_train_y
-        self.test_results = pred_test_y
+    def update_results(self, model, balanced, train_eval, test_eval):
+        # metrics were accumulated with the predictions (see evaluation.Evaluation)
+        self.train_results = train_eval.pred
+        self.test_results = test_eval.pred
         result_ser = pd.Series()
         result_ser['Model'] = model
         result_ser['Balanced'] = balanced
-        if balanced:
-            result_ser['Train Accuracy'] = accuracy_score(self.bal_y_train, pred_train_y)
-            result_ser['Train Log Loss'] = log_loss(self.bal_y_train, train_pred_proba)
-        else:
-            result_ser['Train Accuracy'] = accuracy_score(self.y_train, pred_train_y)
-            result_ser['Train Log Loss'] = log_loss(self.y_train, train_pred_proba)
-        result_ser['Test Accuracy'] = accuracy_score(self.y_test, pred_test_y)
-        result_ser['Test Log Loss'] = log_loss(self.y_test, test_pred_probas)
-        self.results_df = self.results_df.append(result_ser, ignore_index=True)
+        result_ser['Train Accuracy'] = train_eval.accuracy
+        result_ser['Train Log Loss'] = train_eval.log_loss
+        result_ser['Test Accuracy'] = test_eval.accuracy
+        result_ser['Test Log Loss'] = test_eval.log_loss
+        self.append_result(result_ser)
         self.format_results_df()
 
+    def append_result(self, row):
+        # add a results row (pd.Series); DataFrame.append is gone from pandas 2, infer_objects keeps numeric columns as it did
+        self.results_df = pd.concat([self.results_df, row.to_frame().T.infer_objects()], ignore_index=True)
+
     def format_results_df(self):
         self.organized_results = self.results_df[['Model', 'Balanced','Train Log Loss', 'Test Log Loss', 'Train Accuracy','Test Accuracy']]
         self.to_markdown(self.organized_results)
 
-    def create_model(self):
+    def create_model(self, nb_filters=None, kernel_size=None, input_dtype=None):
         """
         Create a simple baseline CNN
 
         Args:
-            input_size (tuple(int, int, int)): 3-dimensional size of input to model
-            n_categories (int): number of classification categories
+            nb_filters (int): filters per convolutional layer (default: self.nb_filters)
+            kernel_size (tuple(int, int)): convolution kernel size (default: self.kernel_size)
+            input_dtype (str): input storage, see self.input_dtype (default: self.input_dtype)
 
         Returns:
             keras Sequential model: model with new head
             """
+        nb_filters = self.nb_filters if nb_filters is None else nb_filters
+        kernel_size = self.kernel_size if kernel_size is None else kernel_size
+        input_dtype = self.input_dtype if input_dtype is None else input_dtype
         model = Sequential()
+        if input_dtype == 'uint8':
+            # preprocess_input (x/127.5 - 1) as the first layer, so raw uint8 images go straight in
+            model.add(Rescaling(1./127.5, offset=-1., input_shape=self.input_size))
         # 2 convolutional layers followed by a pooling layer followed by dropout
-        model.add(Convolution2D(self.nb_filters, 
-                                self.kernel_size,
+        model.add(Convolution2D(nb_filters, 
+                                kernel_size,
                                 padding='valid',
                                 input_shape=self.input_size))
         model.add(Activation('relu'))
-        model.add(Convolution2D(self.nb_filters, 
-                                self.kernel_size))
+        model.add(Convolution2D(nb_filters, 
+                                kernel_size))
         model.add(Activation('relu'))
         model.add(MaxPooling2D(pool_size=self.pool_size))
         model.add(Dropout(0.25))
@@ -429,93 +561,205 @@ class EmotionFaceClassifier():
 
     def run_cnn(self, model_name='CNN_cat', balanced=False, categorical=True):
         self.model = self.create_model()
-        if balanced:
-            x_train = self.bal_x_train
-        else:
-            x_train = self.x_train
-        if categorical and balanced:
-            y_train = self.bal_y_train_cat 
-            y_val = self.y_val_cat
-            y_test = self.y_test_cat
-            loss_fnc = 'categorical_crossentropy'
-        elif categorical and ~balanced:
+        x_train = self.x_train # balanced variants draw balanced batches from the whole training split
+        if categorical:
             y_train = self.y_train_cat 
             y_val = self.y_val_cat
-            y_test = self.y_test_cat
             loss_fnc = 'categorical_crossentropy'
-        elif ~categorical and balanced:
-            y_train = self.bal_y_train 
-            y_val = self.y_val
-            y_test = self.y_test
-            loss_fnc = 'sparse_categorical_crossentropy'
         else:
             y_train = self.y_train 
             y_val = self.y_val
-            y_test = self.y_test
             loss_fnc = 'sparse_categorical_crossentropy'
 
-        self.train_datagen = ImageDataGenerator(preprocessing_function=preprocess_input) #, horizontal_flip=True)
-        self.val_datagen = ImageDataGenerator(preprocessing_function=preprocess_input)
-        self.test_datagen = ImageDataGenerator(preprocessing_function=preprocess_input)
-
-        self.train_datagen.fit(x_train)
-        self.val_datagen.fit(x_train)
-        self.test_datagen.fit(x_train)
-
-
-        self.train_generator = self.train_datagen.flow(x_train, 
-                                                    y_train, 
-                                                    batch_size=self.batch_size, 
-                                                    seed=self.seed_val)
-
-        self.val_generator = self.val_datagen.flow(self.x_val, 
-                                                    y_val, 
-                                                    batch_size=self.batch_size, 
-                                                    seed=self.seed_val)
-
-        self.test_generator = self.test_datagen.flow(self.x_test, 
-                                                    y_test, 
-                                                    batch_size=self.batch_size, 
-                                                    seed=self.seed_val)
+        # tf.data pipelines: parallel preprocess_input, cached preprocessed tensors, prefetch
+        input_args = self.cnn_input_args()
+        self.telemetry = TrainingTelemetry(log_dir='./'+ model_name) # samples/sec, step time, input stall
+        if balanced: # a fresh class-balanced batch every step
+            self.train_generator = make_balanced_dataset(self.cnn_inputs(x_train), 
+                                                         y_train, 
+                                                         BalancedBatchSampler(self.y_train, self.batch_size, seed=self.seed_val), 
+                                                         preprocess_fn=input_args['preprocess_fn'], 
+                                                         on_batch=self.telemetry.mark_ready)
+        else:
+            self.train_generator = make_dataset(self.cnn_inputs(x_train), 
+                                                y_train, 
+                                                batch_size=self.batch_size, 
+                                                shuffle=True, 
+                                                seed=self.seed_val, 
+                                                repeat=True, 
+                                                on_batch=self.telemetry.mark_ready, 
+                                                **input_args)
+
+        self.val_generator = make_dataset(self.cnn_inputs(self.x_val), 
+                                          y_val, 
+                                          batch_size=self.batch_size, 
+                                          repeat=True, 
+                                          **input_args)
         self.model.compile(loss=loss_fnc, 
                             optimizer='rmsprop', 
                             # optimizer='adam', 
                             metrics=["accuracy"] ) # (keep)
-        tb, es, cp = self.gen_callbacks(log_dir='./'+ model_name, 
-                                        best_model_name= model_name +'.hdf5')
-
-        self.model.fit_generator(self.train_generator,
-                                validation_data=self.val_generator, 
-                                validation_steps=self.validation_steps, 
-                                epochs=self.n_epochs, 
-                                steps_per_epoch=self.steps_per_epoch,
-                                callbacks = [tb, es, cp])
-        self.best_model = load_model(self.bestmodelfilepath)
-        self.train_pred_y = self.best_model.predict_classes(x_train)
-        self.test_pred_y = self.best_model.predict_classes(self.x_test)
-        self.train_pred_proba = self.best_model.predict_proba(x_train)
-        self.test_pred_proba = self.best_model.predict_proba(self.x_test)
-        self.update_results(model_name, balanced, self.train_pred_y, self.test_pred_y, self.train_pred_proba, self.test_pred_proba)
-        self.save_cm(self.test_pred_y, model_name)
-        self.metrics = self.best_model.evaluate_generator(self.test_generator, steps=5)
-
-    def gen_callbacks(self, log_dir='./logs', best_model_name='bestmodel.hdf5'):
-        tensorboard = TensorBoard(log_dir=log_dir, 
-                                    batch_size=self.batch_size, 
-                                    write_graph=True, 
-                                    write_grads=True, 
-                                    write_images=True)
+        callbacks = self.gen_callbacks(log_dir='./'+ model_name, 
+                                       best_model_name= model_name +'.hdf5', 
+                                       sample_data=self.val_generator)
+
+        self.model.fit(self.train_generator,
+                        validation_data=self.val_generator, 
+                        validation_steps=self.validation_steps, 
+                        epochs=self.n_epochs, 
+                        steps_per_epoch=self.steps_per_epoch,
+                        callbacks = callbacks + [self.telemetry])
+        if self.checkpoint_mode == 'memory':
+            self.best_model = self.model # best weights restored at the end of fit
+        else:
+            self.best_model = load_model(self.bestmodelfilepath)
+        # one forward pass per split, classes/accuracy/log loss/confusion matrix all from its probabilities
+        self.train_eval = self.evaluate_cnn(self.best_model, x_train, self.y_train)
+        self.test_eval = self.evaluate_cnn(self.best_model, self.x_test, self.y_test)
+        self.train_pred_y, self.train_pred_proba = self.train_eval.pred, self.train_eval.proba
+        self.test_pred_y, self.test_pred_proba = self.test_eval.pred, self.test_eval.proba
+        self.update_results(model_name, balanced, self.train_eval, self.test_eval)
+        self.save_cm(self.test_eval.confusion, model_name)
+        self.metrics = [self.test_eval.log_loss, self.test_eval.accuracy] # as model.evaluate, over the whole test set
+        if self.checkpoint_mode == 'memory':
+            self.checkpoint.wait() # best model file written before the run is reported done
+
+    def evaluate_cnn(self, model, view, y):
+        # streamed single-pass evaluation of a split view, preprocessed as in training
+        return evaluate_model(model, self.cnn_inputs(view), y, self.n_classes,
+                              batch_size=self.eval_batch_size, keep_proba=self.eval_keep_proba,
+                              preprocess_fn=self.cnn_input_args()['preprocess_fn'])
+
+    def run_cnns(self, variants=None):
+        '''
+        Train variants (default: self.cnn_variants) in self.cnn_workers
+        spawned processes. Each worker reopens the shared dataset cache,
+        writes its own confusion matrix png and returns its results row; rows
+        are appended in variants order, as the sequential path would
+        '''
+        variants = self.cnn_variants if variants is None else variants
+        if self.cnn_workers <= 1:
+            for model_name, balanced, categorical in variants:
+                self.run_cnn(model_name=model_name, balanced=balanced, categorical=categorical)
+            return
+        self.cnn_input_buffer() # build a missing preprocessed variant once here, not in every worker at once
+        jobs = [(self.home, self.cv2_path, self.df_path, self.settings(), variant) for variant in variants]
+        for row in run_with_thread_budgets(train_cnn_variant, jobs, n_workers=self.cnn_workers):
+            self.append_result(pd.Series(row))
+
+    def settings(self):
+        # plain-valued settings from __init__ (not emo_dict/emo_list, which remap_labels derives from source_emo_dict)
+        defaults = vars(EmotionFaceClassifier(self.home, self.cv2_path, self.df_path))
+        return {k: getattr(self, k) for k in defaults
+                if k not in ('emo_dict', 'emo_list') and isinstance(getattr(self, k), (bool, int, float, str, tuple, list, dict))}
+
+    def search_cnn(self):
+        '''
+        Successive-halving search over self.search_space on CPU, sparse labels,
+        unbalanced training data; results (val accuracy and wall-clock seconds
+        per config and rung) in self.search_df and ../images/cnn_search.csv
+        '''
+        configs = sample_configs(self.search_space, self.search_n_configs, seed=self.seed_val,
+                                 conditions=self.search_conditions)
+        print(f'Searching {len(configs)} CNN configurations')
+        search = SuccessiveHalving(self.build_search_model, self.train_search_model, configs,
+                                   min_epochs=self.search_min_epochs, max_epochs=self.search_max_epochs,
+                                   eta=self.search_eta)
+        with tf.device('/CPU:0'):
+            self.search_df = search.run()
+        self.search_df.to_csv('../images/cnn_search.csv', index=False)
+        print(f'Best configuration: {search.best_config}')
+        self.to_markdown(self.search_df.sort_values(['rung', 'val_accuracy'], ascending=False))
+        return search.best_config
+
+    def build_search_model(self, config):
+        # compiled model for a search config, create_model uses the config's filters/kernel
+        if config['builder'] == 'create_model':
+            model = self.create_model(config['nb_filters'], config['kernel_size'], input_dtype='float32')
+        else:
+            builder = getattr(simple_cnn, config['builder'].split('.')[-1])
+            model = builder(self.input_size, self.n_classes)
+        model.compile(loss='sparse_categorical_crossentropy', optimizer='rmsprop', metrics=['accuracy'])
+        return model
+
+    def train_search_model(self, model, config, initial_epoch, epochs):
+        # continue training to `epochs`, return the last validation accuracy
+        train = make_dataset(self.x_train, self.y_train, batch_size=config['batch_size'],
+                             shuffle=True, seed=self.seed_val, repeat=True)
+        val = make_dataset(self.x_val, self.y_val, batch_size=config['batch_size'], repeat=True)
+        history = model.fit(train, validation_data=val, validation_steps=self.validation_steps,
+                            initial_epoch=initial_epoch, epochs=epochs,
+                            steps_per_epoch=config['steps_per_epoch'], verbose=0)
+        metrics = history.history
+        return (metrics.get('val_accuracy') or metrics['val_acc'])[-1]
+
+    def cnn_input_buffer(self):
+        # image buffer the CNN reads, by self.input_dtype
+        if self.input_dtype != 'float16':
+            return self.images
+        variant = self.cache.variant(self.source_key, {'preprocess': 'xception', 'dtype': 'float16'})
+        if variant.get('images', mmap_mode='r') is None:
+            print('Caching preprocessed float16 images')
+            out = variant.create('images', self.images.shape, 'float16') # chunks go straight to disk
+            variant.finish('images', preprocess_images(self.images, 'float16', out=out))
+        return variant.get('images', mmap_mode='r')
+
+    def cnn_inputs(self, view):
+        # same rows as a split view, read from the CNN input buffer
+        return ImageView(self.cnn_input_buffer(), view.idx, 'channels_last')
+
+    def cnn_input_args(self):
+        # make_dataset arguments by self.input_dtype
+        return {'float32': {'preprocess_fn': preprocess, 'cache': True},
+                'float16': {'preprocess_fn': to_float32, 'cache': False},
+                'uint8': {'preprocess_fn': None, 'cache': False}}[self.input_dtype]
+
+    def gen_callbacks(self, log_dir='./logs', best_model_name='bestmodel.hdf5', sample_data=None):
+        # sample_data: (x, y) batches whose first batch the 'sampled' gradient histograms use
+        callbacks = []
+        if self.tensorboard_mode == 'scalars':
+            callbacks.append(TensorBoard(log_dir=log_dir, 
+                                         write_graph=False, 
+                                         histogram_freq=0, 
+                                         update_freq='epoch'))
+        elif self.tensorboard_mode == 'sampled':
+            # heavy serialization, only every tensorboard_sample_every epochs
+            callbacks.append(TensorBoard(log_dir=log_dir, 
+                                         histogram_freq=self.tensorboard_sample_every, 
+                                         write_graph=True, 
+                                         write_images=True))
+            callbacks.append(GradientHistograms(log_dir, sample_data, every=self.tensorboard_sample_every))
         earlystop = EarlyStopping(monitor='loss',
                                       min_delta=0,
                                       patience=2,
                                       verbose=0, mode='auto')
         self.bestmodelfilepath = best_model_name
-        checkpoint = ModelCheckpoint(self.bestmodelfilepath, 
-                                        monitor='acc', 
-                                        verbose=1, 
-                                        save_best_only=True, 
-                                        mode='max')
-        return tensorboard, earlystop, checkpoint
+        # log name of the compiled 'accuracy' metric (keras 2.3+; older versions logged 'acc')
+        monitor = 'accuracy'
+        if self.checkpoint_mode == 'memory':
+            self.checkpoint = BestWeightsCheckpoint(self.bestmodelfilepath, 
+                                                    monitor=monitor, 
+                                                    verbose=1, 
+                                                    mode='max')
+        else:
+            self.checkpoint = ModelCheckpoint(self.bestmodelfilepath, 
+                                            monitor=monitor, 
+                                            verbose=1, 
+                                            save_best_only=True, 
+                                            mode='max')
+        return callbacks + [earlystop, self.checkpoint]
+
+def train_cnn_variant(home, cv2_path, df_path, settings, variant):
+    '''Worker for run_cnns: rebuild the data stages from the cache and train one CNN variant'''
+    efc = EmotionFaceClassifier(home, cv2_path, df_path)
+    efc.__dict__.update(settings)
+    efc.load_data()
+    efc.remap_labels(efc.label_spec)
+    efc.split_x_y()
+    efc.balanced_split_x_y()
+    model_name, balanced, categorical = variant
+    efc.run_cnn(model_name=model_name, balanced=balanced, categorical=categorical)
+    return efc.results_df.iloc[-1].to_dict()
 
 if __name__=='__main__':
     home = '/home/danny/Desktop/galvanize/emotion_face_classification/src/'
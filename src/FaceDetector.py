@@ -11,7 +11,10 @@ from time import sleep
 from keras.models import load_model
 from scipy import stats
 from collections import Counter
+from functools import partial
 from drawnow import drawnow
+from video_pipeline import VideoPipeline
+from face_tracking import FaceTracker, MultiResolutionDetector
 
 class EmotionFacePredictor():
     '''
@@ -26,6 +29,12 @@ class EmotionFacePredictor():
         self.emo_colors = ['red', 'grey', 'yellow', 'blue', 'orange', 'tan']
         self.x_range = list(range(6))
         self.emo_list = list(self.emo_dict.values()) # labels 
+        self.face_size = (48, 48) # model input size of a face crop
+        self.batch = None # preallocated (n, 48, 48, 1) face batch, grown as needed
+        self.pending = None # face crops waiting for a cross-frame micro-batch (see read_frame_batched)
+        self.tracker = None # FaceTracker when classify_faces_video runs in tracking mode
+        self.multires = False # full-frame detection with MultiResolutionDetector instead of detect_faces
+        self.detector = self.detect_faces # gray -> boxes of the detection mode (see frame_detector)
 
     def run_setup(self):
         self.load_model()
@@ -51,87 +60,74 @@ class EmotionFacePredictor():
     def classify_faces_image(self, img):
         self.img = cv2.imread(img)
         self.gray = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY) # convert img to grayscale
-        faces = self.faceCascade.detectMultiScale(
-            self.gray,
-            scaleFactor=1.1,
-            minNeighbors=5,
-            minSize=(30, 30),
-            flags=cv2.CASCADE_SCALE_IMAGE
-        )
+        faces = self.detect_faces(self.gray)
         print(f'Found {len(faces)} faces')
         if len(faces)>0:
-            # Create array to average responses
-            face_paths = []
-            df_probas = []
-            df_predict = []
-            cnt = 1
-            # Draw a rectangle around the faces
-            for (x, y, w, h) in faces:
-                cv2.rectangle(self.gray, (x, y), (x+w, y+h), (0, 255, 0), 2)
-                self.sub_face = self.gray[y:y+h, x:x+w]
-                sb2 = cv2.resize(self.sub_face, (48, 48)) 
-                sb3 = np.expand_dims(sb2, axis=3) 
-                sb4 = np.array([sb3])
-                f_path = './static/images/face_'+str(cnt)+'.png'
-                cv2.imwrite(f_path, self.sub_face)
-                face_paths.append(f_path)
-                self.test_pred_y = self.best_model.predict_classes(sb4)
-                self.test_pred_proba = self.best_model.predict_proba(sb4)
-                print(self.test_pred_y)
-                print(self.test_pred_proba)
-                print(self.emo_dict[self.test_pred_y[0]])
-                cnt +=1 
-                df_probas.append(self.test_pred_proba)
-                df_predict.append(self.test_pred_y)
+            face_paths = ['./static/images/face_'+str(cnt)+'.png' for cnt in range(1, len(faces)+1)]
+            # Draw a rectangle around the faces, classify all of them in one batch
+            batch = self.crop_faces(self.gray, faces, crop_files=face_paths)
+            predicts, probas = self.predict_batch(batch)
+            self.print_predictions(predicts, probas)
             print('I SHOULD BE RETURNING STUFF')
-            return (face_paths, np.array(df_predict), np.array(df_probas))
+            # (n, 1) classes and (n, 1, 6) probabilities, as one predict per face returned
+            return (face_paths, predicts[:, np.newaxis], probas[:, np.newaxis, :])
         else:
             print('No faces found!')
             return None
 
-    def classify_faces_video(self,file_path=0,duration=15, write_imgs=False, output_name='test', show_plots=True, show_final_plot=True):
+    def classify_faces_video(self,file_path=0,duration=15, write_imgs=False, output_name='test', show_plots=True, show_final_plot=True,
+                             batch_size=None, max_latency=0.1, n_detectors=None, track_every=None,
+                             multires=False):
         # Setting file_path = 0 will capture from webcam
         # Setting duration to 0 or None will run continuously
+        # Setting batch_size classifies faces from consecutive frames together, in batches of up to
+        # batch_size faces or whatever arrived within max_latency seconds (same outputs, fewer model calls)
+        # Setting n_detectors runs the threaded pipeline (see video_pipeline.VideoPipeline) with that many
+        # detection workers, micro-batching with batch_size (default 32) and max_latency
+        # Setting track_every runs full-frame detection only every track_every frames and tracks faces
+        # around their previous boxes in between (see face_tracking.FaceTracker); higher is faster, but
+        # new faces can be picked up to track_every-1 frames late. Not available with n_detectors
+        # Setting multires detects faces on a downscaled frame and confirms them at full resolution, with
+        # the smallest face relative to the frame height (see face_tracking.MultiResolutionDetector)
+        if n_detectors and track_every:
+            raise ValueError('track_every needs frames in order, it cannot be combined with n_detectors')
         self.capture_duration = duration
+        self.multires = multires
+        self.detector = self.frame_detector()
+        self.tracker = FaceTracker(self.detect_faces, keyframe_interval=track_every,
+                                   keyframe_detect=self.detector) if track_every else None
         start_time = time.time()
         video_capture = cv2.VideoCapture(file_path)
         self.total_df_probas = []
         self.total_df_predict = []
         self.ret = True
+        if batch_size:
+            self.reset_micro_batch(batch_size)
         if show_plots:
             plt.ion()
-        if duration:
+        if n_detectors:
+            self.run_pipeline(video_capture, start_time, write_imgs, show_plots, n_detectors,
+                              batch_size or 32, max_latency)
+        elif duration:
             while( int(time.time() - start_time) < self.capture_duration ):
                 # Capture frame-by-frame
-                self.probas, self.predicts = self.read_frame(vc = video_capture, write_imgs=write_imgs)
-                if not self.ret:
+                if not self.next_frames(video_capture, write_imgs, show_plots, batch_size, max_latency):
                     break 
-                print(self.probas)
-                print(self.predicts)
-                for proba, predict in zip(self.probas, self.predicts):
-                    self.total_df_probas.append(proba[0])
-                    self.total_df_predict.append(predict)
-                if show_plots:
-                    self.interactive_plot()
                 if cv2.waitKey(1) & 0xFF == ord('q'):
                     plt.clf()
                     break
         else:
             while True:
                 # Capture frame-by-frame
-                self.probas, self.predicts = self.read_frame(vc = video_capture, write_imgs=write_imgs)
-                if not self.ret:
+                if not self.next_frames(video_capture, write_imgs, show_plots, batch_size, max_latency):
                     break 
-                print(self.probas)
-                print(self.predicts)
-                for proba, predict in zip(self.probas, self.predicts):
-                    self.total_df_probas.append(proba[0])
-                    self.total_df_predict.append(predict)
-                if show_plots:
-                    self.interactive_plot()
                 if cv2.waitKey(1) & 0xFF == ord('q'):
                     plt.clf()
                     break
+        if batch_size:
+            self.record_frames(self.flush_frames(), show_plots) # frames still waiting for a micro-batch
+        if self.tracker:
+            self.print_detection_report()
         #Final Saves and plots
         try:
             self.means_to_plot = np.array(self.total_df_probas).mean(0)
@@ -155,13 +151,53 @@ class EmotionFacePredictor():
             cmd = 'eog '+ output_plot
             os.system(cmd)
 
-    def interactive_plot(self):
+    def run_pipeline(self, video_capture, start_time, write_imgs, show_plots, n_detectors, batch_size, max_latency):
+        # frames decoded, detected and classified concurrently, recorded here in frame order
+        pipeline = VideoPipeline(self, n_detectors=n_detectors, batch_size=batch_size,
+                                 max_latency=max_latency, write_imgs=write_imgs)
+        results = pipeline.run(video_capture)
+        for frame, result in results:
+            if show_plots:
+                plt.clf()
+            self.record_frames([(frame, result)], show_plots)
+            if self.capture_duration and int(time.time() - start_time) >= self.capture_duration:
+                break
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                plt.clf()
+                break
+        results.close() # stops the pipeline threads if we left early
+
+    def next_frames(self, vc, write_imgs, show_plots, batch_size=None, max_latency=0.1):
+        # read a frame and record the frames whose classification completed, False at the end of the video
+        if batch_size:
+            results = self.read_frame_batched(vc, write_imgs=write_imgs, batch_size=batch_size, max_latency=max_latency)
+        else:
+            result = self.read_frame(vc = vc, write_imgs=write_imgs)
+            results = [(self.frame, result)]
+        if not self.ret:
+            return False
+        self.record_frames(results, show_plots)
+        return True
+
+    def record_frames(self, results, show_plots):
+        # results: (frame, (probas, predicts)) per frame; plots show the frame the prediction was made on
+        for frame, (probas, predicts) in results:
+            self.probas, self.predicts = probas, predicts
+            print(self.probas)
+            print(self.predicts)
+            for proba, predict in zip(self.probas, self.predicts):
+                self.total_df_probas.append(proba[0])
+                self.total_df_predict.append(predict)
+            if show_plots:
+                self.interactive_plot(frame)
+
+    def interactive_plot(self, frame):
         self.means_to_plot = np.array(self.total_df_probas).mean(0)
         plt.bar(self.x_range, self.means_to_plot.reshape(6), color=self.emo_colors)
         plt.title(self.emo_dict[self.predicts[0]])
         plt.xticks(range(6), list(self.emo_dict.values()))
         plt.ylim(0,1)
-        cv2.imshow('Video', self.frame)
+        cv2.imshow('Video', frame)
         plt.draw()
         plt.pause(.01)
 
@@ -170,43 +206,159 @@ class EmotionFacePredictor():
         self.ret, self.frame = vc.read()
         if self.ret:
             gray = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
-            faces = self.faceCascade.detectMultiScale(
-                gray,
-                scaleFactor=1.1,
-                minNeighbors=5,
-                minSize=(30, 30),
-                flags=cv2.CASCADE_SCALE_IMAGE
-                )
+            faces = self.find_faces(gray)
             print(f'Found {len(faces)} faces')
             plt.clf()
             if len(faces)>0:
-                self.temp_df_probas = []
-                self.temp_df_predict = []
-                # Draw a rectangle around the faces
-                for (x, y, w, h) in faces:
-                    cv2.rectangle(self.frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
-                    sub_face = self.frame[y:y+h, x:x+w]
-                    if write_imgs:
-                        face_file_name = "faces/face_" + str(y) + ".jpg"
-                        cv2.imwrite(face_file_name, sub_face)
-                    gray_image = cv2.cvtColor(sub_face, cv2.COLOR_BGR2GRAY)
-                    sb2 = cv2.resize(gray_image, (48, 48)) 
-                    sb3 = np.expand_dims(sb2, axis=3) 
-                    sb4 = np.array([sb3])
-                    self.test_pred_y = self.best_model.predict_classes(sb4)
-                    self.test_pred_proba = self.best_model.predict_proba(sb4)
-                    print(self.test_pred_y)
-                    print(self.test_pred_proba)
-                    print(self.emo_dict[self.test_pred_y[0]])
-                    self.temp_df_probas.append(self.test_pred_proba)
-                    self.temp_df_predict.append(self.test_pred_y[0])
+                # Draw a rectangle around the faces, classify all of them in one batch
+                crop_files = ["faces/face_" + str(y) + ".jpg" for (x, y, w, h) in faces] if write_imgs else None
+                batch = self.crop_faces(self.frame, faces, color=True, crop_files=crop_files)
+                predicts, probas = self.predict_batch(batch)
+                self.print_predictions(predicts, probas)
+                # a (1, 6) probability array and a class per face
+                self.temp_df_probas = [probas[i:i+1] for i in range(len(faces))]
+                self.temp_df_predict = list(predicts)
             else:
-                self.temp_df_probas=[np.array([np.array([0, 0, 0, 0, 0, 0])])]
-                self.temp_df_predict = [99]
+                self.temp_df_probas, self.temp_df_predict = self.no_face_result()
             return self.temp_df_probas, self.temp_df_predict
         else: 
             return None, None
 
+    @staticmethod
+    def no_face_result():
+        # what a frame without faces contributes to the totals
+        return [np.array([np.array([0, 0, 0, 0, 0, 0])])], [99]
+
+    def find_faces(self, gray):
+        # face boxes of the next frame: tracked in tracking mode, full detection otherwise
+        return self.detector(gray) if self.tracker is None else self.tracker(gray)
+
+    def frame_detector(self, cascade=None):
+        # gray -> boxes function of the detection mode (cascade: e.g. a worker thread's own classifier)
+        detect = partial(self.detect_faces, cascade=cascade)
+        return MultiResolutionDetector(detect) if self.multires else detect
+
+    def detect_faces(self, gray, cascade=None, **overrides):
+        # Haar cascade detection on a gray frame (cascade: e.g. a worker thread's own classifier,
+        # overrides: detectMultiScale arguments, e.g. the face sizes of a tracking search)
+        cascade = self.faceCascade if cascade is None else cascade
+        params = dict(scaleFactor=1.1, minNeighbors=5, minSize=(30, 30), flags=cv2.CASCADE_SCALE_IMAGE)
+        params.update(overrides)
+        return cascade.detectMultiScale(gray, **params)
+
+    def print_detection_report(self):
+        self.detection_report = self.tracker.report()
+        report = self.detection_report
+        print(f"Tracking every {self.tracker.keyframe_interval} frames: {report['full_detections']} full detections "
+              f"for {report['frames']} frames ({report['full_detections_saved']} saved, "
+              f"{report['fallbacks']} fallbacks to full detection, {report['roi_searches']} local searches)")
+
+    def reset_micro_batch(self, batch_size):
+        self.pending = np.empty((batch_size, self.face_size[0], self.face_size[1], 1), dtype=np.uint8)
+        self.n_pending = 0 # faces queued
+        self.pending_frames = [] # (face count, frame) of every queued frame, in order
+        self.pending_since = None # time the oldest queued frame was read
+
+    def read_frame_batched(self, vc, write_imgs=False, batch_size=32, max_latency=0.1):
+        '''
+        read_frame for cross-frame micro-batching: the frame's face crops are
+        queued, and the queue is classified in one forward pass once it holds
+        batch_size faces or its oldest frame is max_latency seconds old
+
+        Returns:
+            list of (frame, (probas, predicts)), with (probas, predicts) as
+            read_frame returns them, for every frame completed by this call,
+            in frame order (often empty)
+            '''
+        self.ret, self.frame = vc.read()
+        if not self.ret:
+            return []
+        gray = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
+        faces = self.find_faces(gray)
+        print(f'Found {len(faces)} faces')
+        plt.clf()
+        if len(faces)>0:
+            if self.n_pending + len(faces) > len(self.pending): # a crowded frame, grow the queue
+                grown = np.empty((self.n_pending + len(faces),) + self.pending.shape[1:], dtype=np.uint8)
+                grown[:self.n_pending] = self.pending[:self.n_pending]
+                self.pending = grown
+            crop_files = ["faces/face_" + str(y) + ".jpg" for (x, y, w, h) in faces] if write_imgs else None
+            self.crop_faces(self.frame, faces, color=True, crop_files=crop_files,
+                            out=self.pending[self.n_pending:self.n_pending+len(faces)])
+            self.n_pending += len(faces)
+        self.pending_frames.append((len(faces), self.frame))
+        if self.pending_since is None:
+            self.pending_since = time.time()
+        if self.n_pending >= batch_size or time.time() - self.pending_since >= max_latency:
+            return self.flush_frames()
+        return []
+
+    def flush_frames(self):
+        # classify every queued face in one forward pass and hand the results back to their frames, in order
+        if not self.pending_frames:
+            return []
+        if self.n_pending:
+            predicts, probas = self.predict_batch(self.pending[:self.n_pending])
+            self.print_predictions(predicts, probas)
+        results = []
+        start = 0
+        for n_faces, frame in self.pending_frames:
+            if n_faces:
+                results.append((frame, ([probas[i:i+1] for i in range(start, start+n_faces)],
+                                        list(predicts[start:start+n_faces]))))
+                start += n_faces
+            else:
+                results.append((frame, self.no_face_result()))
+        self.n_pending, self.pending_frames, self.pending_since = 0, [], None
+        return results
+
+    def batch_buffer(self, n):
+        # first n slots of the preallocated face batch (reallocated only when a frame has more faces)
+        if self.batch is None or len(self.batch) < n:
+            self.batch = np.empty((max(n, 8), self.face_size[0], self.face_size[1], 1), dtype=np.uint8)
+        return self.batch[:n]
+
+    def crop_faces(self, img, faces, color=False, crop_files=None, out=None):
+        '''
+        Fill the face batch with the 48x48 gray crop of every face
+
+        Each face's rectangle is drawn on img before it is cropped, in
+        detection order, as the per-face loop did
+
+        Args:
+            img (np.ndarray): frame the faces were found in
+            faces (np.ndarray): (n, 4) x, y, w, h boxes from detectMultiScale
+            color (bool): img is BGR, crops are converted to gray
+            crop_files (list of str): if given, each (unresized) crop is written to these paths
+            out (np.ndarray): (n, 48, 48, 1) uint8 array to fill instead of the face batch
+
+        Returns:
+            np.ndarray: (n, 48, 48, 1) uint8 batch (a view of the preallocated buffer)
+            '''
+        batch = self.batch_buffer(len(faces)) if out is None else out
+        for i, (x, y, w, h) in enumerate(faces):
+            cv2.rectangle(img, (x, y), (x+w, y+h), (0, 255, 0), 2)
+            sub_face = img[y:y+h, x:x+w]
+            if crop_files:
+                cv2.imwrite(crop_files[i], sub_face)
+            if color:
+                sub_face = cv2.cvtColor(sub_face, cv2.COLOR_BGR2GRAY)
+            batch[i, :, :, 0] = cv2.resize(sub_face, self.face_size)
+        return batch
+
+    def predict_batch(self, batch):
+        # one forward pass for the whole batch; the class is the argmax of the probabilities (as predict_classes)
+        probas = np.asarray(self.best_model.predict_on_batch(batch))
+        predicts = probas.argmax(1)
+        self.test_pred_y, self.test_pred_proba = predicts[-1:], probas[-1:] # last face, as before
+        return predicts, probas
+
+    def print_predictions(self, predicts, probas):
+        for i in range(len(predicts)):
+            print(predicts[i:i+1])
+            print(probas[i:i+1])
+            print(self.emo_dict[predicts[i]])
+
 if __name__=='__main__':
     home = '/home/danny/Desktop/galvanize/emotion_face_classification/src/'
     # home = '/home/ubuntu/efc/src/'
@@ -39,7 +39,8 @@ if __name__=='__main__':
                                         write_imgs=False, 
                                         output_name=title, 
                                         show_plots=False,
-                                        show_final_plot=False)
+                                        show_final_plot=False,
+                                        track_every=5) # full detection on every 5th frame, faces tracked in between
         if not os.path.isfile('../images/' + title + '_2.png'):
             proba_path = '../images/'+ title + '_probas.txt'
             if os.path.isfile(proba_path):
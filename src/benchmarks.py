@@ -0,0 +1,407 @@
+'''
+Benchmarks for the data and inference paths.
+
+Run from src/, e.g.:
+    python benchmarks.py parse --csv ../stims/fer2013.csv
+Without --csv a synthetic FER2013-sized dataset is generated. Video
+benchmarks read --video (detect: every video in --videos) with --model and
+the Haar cascades in --cascade_dir.
+'''
+import os
+import glob
+import time
+import argparse
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+import numpy as np
+import pandas as pd
+from fer_data import parse_pixels, save_dataset, load_dataset, IMG_SIZE
+from splits import ImageView, usage_indices, balanced_positions
+from decomposition_compare import DecompositionComparison
+
+
+def synthetic_fer(n_rows=35887, seed=1):
+    '''Random FER2013-like frame (emotion, pixels, Usage)'''
+    rng = np.random.RandomState(seed)
+    imgs = rng.randint(0, 256, size=(n_rows, IMG_SIZE))
+    pixels = [' '.join(map(str, row)) for row in imgs]
+    usage = np.where(np.arange(n_rows) < int(n_rows*.8), 'Training',
+                     np.where(np.arange(n_rows) < int(n_rows*.9), 'PublicTest', 'PrivateTest'))
+    return pd.DataFrame({'emotion': rng.randint(0, 7, n_rows), 'pixels': pixels, 'Usage': usage})
+
+
+def load_fer(csv_path=None, n_rows=35887):
+    if csv_path:
+        return pd.read_csv(csv_path)
+    print(f'Generating {n_rows} synthetic rows')
+    return synthetic_fer(n_rows)
+
+
+def timed(fnc, *args, repeat=3, **kwargs):
+    '''Best-of-N wall clock time of fnc(*args, **kwargs) and its last result'''
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fnc(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _legacy_convert_pixels_to_array(pixels):
+    # per-row parser previously used via DataFrame.apply in gen_arrays
+    array = np.array([int(x) for x in pixels.split(' ')]).reshape(48,48)
+    array = np.array(array, dtype='uint8')
+    return array
+
+
+def bench_parse(args):
+    df = load_fer(args.csv, args.rows)
+    legacy_time, legacy = timed(lambda: np.stack(df['pixels'].apply(_legacy_convert_pixels_to_array).values), repeat=1)
+    print(f'apply(convert_pixels_to_array): {legacy_time:.2f}s')
+    for chunk_size in [None, 4096, 1024]:
+        t, imgs = timed(parse_pixels, df['pixels'], chunk_size=chunk_size)
+        assert np.array_equal(imgs, legacy)
+        print(f'parse_pixels(chunk_size={chunk_size}): {t:.2f}s ({legacy_time/t:.1f}x)')
+
+
+def bench_cache(args):
+    df = load_fer(args.csv, args.rows)
+    images = parse_pixels(df.pop('pixels'))
+    with tempfile.TemporaryDirectory() as tmp:
+        # previous format: pickled DataFrame with one numpy object per row
+        pkl_path = os.path.join(tmp, 'fer2013_ouput.pkl')
+        legacy = df.copy()
+        legacy['img_array'] = [img.copy() for img in images]
+        legacy.to_pickle(pkl_path)
+        pkl_time, _ = timed(pd.read_pickle, pkl_path)
+        print(f'read_pickle: {pkl_time*1000:.1f}ms ({os.path.getsize(pkl_path)/1e6:.0f}MB)')
+        cache_dir = os.path.join(tmp, 'fer2013_cache')
+        save_dataset(cache_dir, images, df['emotion'], df['Usage'])
+        cache_time, (cached, labels, _) = timed(load_dataset, cache_dir)
+        assert np.array_equal(cached, images) and labels['Usage'].astype(str).equals(df['Usage'])
+        del cached # release the memmap before the directory is removed
+        print(f'load_dataset (mmap): {cache_time*1000:.1f}ms ({pkl_time/cache_time:.0f}x)')
+
+
+def peak_rss_mb():
+    # peak resident set size of this process (ru_maxrss is KB on linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fresh_processes(n):
+    '''
+    n single-worker pools to measure peak RSS in isolation. Start them
+    before allocating anything large: ru_maxrss survives fork and exec.
+    '''
+    return [multiprocessing.get_context('spawn').Pool(1) for _ in range(n)]
+
+
+def _splits_legacy(cache_dir):
+    # stacked copies per split, as split_x_y/balanced_split_x_y did before
+    # (base before loading: ru_maxrss is a high-water mark, so a later base would hide the splits under the load peak)
+    base = peak_rss_mb()
+    images, df, _ = load_dataset(cache_dir, mmap_mode=None)
+    df['img_array'] = [img.copy() for img in images] # per-row objects of the old pickled DataFrame
+    del images
+    train_data = df[df['Usage']=='Training']
+    x_train = np.stack(train_data['img_array'].values)
+    x_val = np.stack(df[df['Usage']=='PublicTest']['img_array'].values)
+    x_test = np.stack(df[df['Usage']=='PrivateTest']['img_array'].values)
+    x_train_flat, x_val_flat, x_test_flat = [x.reshape(x.shape[0], -1) for x in [x_train, x_val, x_test]]
+    x_train, x_val, x_test = [np.expand_dims(x, axis=3) for x in [x_train, x_val, x_test]]
+    groups = train_data.groupby('emotion')
+    bal_df = groups.apply(lambda x: x.sample(groups.size().min(), random_state=1).reset_index(drop=True))
+    bal_x_train = np.stack(bal_df['img_array'].values)
+    bal_x_train_flat = bal_x_train.reshape(bal_x_train.shape[0], -1)
+    bal_x_train = np.expand_dims(bal_x_train, axis=3)
+    checksum = int(x_train_flat.sum(dtype=np.int64)) # a model reading every training row once
+    return base, peak_rss_mb(), checksum
+
+
+def _splits_views(cache_dir):
+    base = peak_rss_mb()
+    images, df, _ = load_dataset(cache_dir)
+    train_idx = usage_indices(df, 'Training')
+    x_train = ImageView(images, train_idx, 'channels_last')
+    x_val = ImageView(images, usage_indices(df, 'PublicTest'), 'channels_last')
+    x_test = ImageView(images, usage_indices(df, 'PrivateTest'), 'channels_last')
+    x_train_flat, x_val_flat, x_test_flat = x_train.flat(), x_val.flat(), x_test.flat()
+    bal_x_train = x_train.subset(balanced_positions(df['emotion'].values[train_idx], 1))
+    bal_x_train_flat = bal_x_train.flat()
+    # a model reading every training row once
+    checksum = sum(int(x_train_flat[i:i+4096].sum(dtype=np.int64)) for i in range(0, len(x_train_flat), 4096))
+    return base, peak_rss_mb(), checksum
+
+
+def bench_splits(args):
+    pools = fresh_processes(2)
+    df = load_fer(args.csv, args.rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_dir = os.path.join(tmp, 'fer2013_cache')
+        save_dataset(cache_dir, parse_pixels(df.pop('pixels')), df['emotion'], df['Usage'])
+        del df
+        checksums = []
+        for pool, name, fnc in zip(pools, ['stacked copies', 'index views'], [_splits_legacy, _splits_views]):
+            with pool:
+                base, peak, checksum = pool.apply(fnc, (cache_dir,))
+            checksums.append(checksum)
+            print(f'{name}: peak RSS {peak:.0f}MB (+{peak-base:.0f}MB for data and splits), '
+                  f'training pixel sum {checksum}')
+        assert checksums[0] == checksums[1], 'index views read different training rows than the stacked copies'
+
+
+def _legacy_decomposition(images, groups, values, model):
+    # one fit per (component count, group), as the comparison methods did before
+    out = {}
+    for val in values:
+        for name, rows in groups.items():
+            flat = images[rows].reshape(len(rows), -1)
+            out[(name, val)] = model(n_components=val).fit(flat).components_.mean(0)
+    return out
+
+
+def bench_decomposition(args):
+    from sklearn import decomposition
+    values = [1, 3, 5, 10]
+    df = load_fer(args.csv, args.rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_dir = os.path.join(tmp, 'fer2013_cache')
+        save_dataset(cache_dir, parse_pixels(df.pop('pixels')), df['emotion'], df['Usage'])
+        images, df, _ = load_dataset(cache_dir)
+        groups = {'Overall': usage_indices(df, 'Training')}
+        for emo_val in sorted(df['emotion'].unique()):
+            groups[str(emo_val)] = df.index.values[(df['emotion']==emo_val).values]
+        comparison = DecompositionComparison(images, groups, values)
+        for name, model, fnc in [('PCA', decomposition.PCA, comparison.pca_components),
+                                 ('NMF', decomposition.NMF, comparison.nmf_components)]:
+            legacy_time, _ = timed(_legacy_decomposition, images, groups, values, model, repeat=1)
+            t, _ = timed(fnc, repeat=1)
+            print(f'{name}: sequential {legacy_time:.1f}s, comparison engine {t:.1f}s ({legacy_time/t:.1f}x)')
+        del images
+
+
+def bench_pipeline(args):
+    '''
+    Check make_dataset against ImageDataGenerator(preprocess_input).flow,
+    then compare input throughput (images/sec) over several epochs
+    '''
+    from keras.preprocessing.image import ImageDataGenerator
+    from keras.applications.xception import preprocess_input
+    from input_pipeline import make_dataset
+    batch_size, n_epochs, steps = 512, 3, 50
+    df = load_fer(args.csv, args.rows)
+    x = np.expand_dims(parse_pixels(df.pop('pixels')), axis=3)
+    y = df['emotion'].values
+    # equivalence, unshuffled
+    flow = ImageDataGenerator(preprocessing_function=preprocess_input).flow(x, y, batch_size=batch_size, shuffle=False)
+    for (ref_x, ref_y), (new_x, new_y) in zip([flow[i] for i in range(len(flow))], make_dataset(x, y, batch_size)):
+        assert np.allclose(ref_x, new_x.numpy(), atol=1e-6) and np.array_equal(ref_y, new_y.numpy())
+    print('make_dataset matches ImageDataGenerator(preprocess_input).flow')
+    # throughput, shuffled and repeating as in run_cnn
+    flow = ImageDataGenerator(preprocessing_function=preprocess_input).flow(x, y, batch_size=batch_size, seed=1)
+    ds = iter(make_dataset(x, y, batch_size, shuffle=True, seed=1, repeat=True))
+    for name, batches in [('ImageDataGenerator.flow', flow), ('tf.data', ds)]:
+        start = time.perf_counter()
+        n_imgs = sum(len(next(batches)[0]) for _ in range(n_epochs * steps))
+        print(f'{name}: {n_imgs / (time.perf_counter() - start):.0f} images/sec')
+
+
+def bench_evaluate(args):
+    '''
+    Check the single-pass evaluator against sklearn metrics on separate
+    predict calls, then compare the old four predicts + evaluate against one
+    forward pass per split
+    '''
+    from sklearn.metrics import accuracy_score, log_loss, confusion_matrix
+    from keras.models import Sequential
+    from keras.layers import Convolution2D, Dense, Flatten, MaxPooling2D
+    from input_pipeline import make_dataset
+    from evaluation import evaluate_model
+    df = load_fer(args.csv, args.rows)
+    x = np.expand_dims(parse_pixels(df.pop('pixels')), axis=3)
+    y = df['emotion'].values
+    n_classes = y.max() + 1
+    model = Sequential([Convolution2D(32, (3, 3), activation='relu', input_shape=x.shape[1:]),
+                        MaxPooling2D((4, 4)), Flatten(), Dense(n_classes, activation='softmax')])
+    model.compile(loss='sparse_categorical_crossentropy', optimizer='rmsprop', metrics=['accuracy'])
+    n_train = int(len(x) * .8)
+    splits = [(x[:n_train], y[:n_train]), (x[n_train:], y[n_train:])]
+
+    def legacy():
+        # predict_classes and predict_proba per split (predict_classes = argmax of predict), then evaluate
+        for split_x, split_y in splits:
+            ds = make_dataset(split_x, split_y, 512, cache=False)
+            pred = model.predict(ds, verbose=0).argmax(1)
+            proba = model.predict(ds, verbose=0)
+            accuracy_score(split_y, pred), log_loss(split_y, proba), confusion_matrix(split_y, pred)
+        model.evaluate(make_dataset(*splits[1], 512, cache=False), verbose=0)
+        return pred, proba
+
+    def single_pass():
+        return [evaluate_model(model, split_x, split_y, n_classes, cache=False) for split_x, split_y in splits]
+
+    legacy_time, (pred, proba) = timed(legacy, repeat=1)
+    new_time, (_, test_eval) = timed(single_pass, repeat=1)
+    test_y = splits[1][1]
+    assert np.array_equal(test_eval.pred, pred) and np.allclose(test_eval.proba, proba, atol=1e-6)
+    assert np.isclose(test_eval.accuracy, accuracy_score(test_y, pred))
+    assert np.isclose(test_eval.log_loss, log_loss(test_y, proba), rtol=1e-5)
+    assert np.array_equal(test_eval.confusion, confusion_matrix(test_y, pred, labels=range(n_classes)))
+    print('single-pass evaluation matches predict + sklearn metrics')
+    print(f'predict x4 + evaluate: {legacy_time:.2f}s, single pass: {new_time:.2f}s')
+
+
+def face_predictor(args):
+    from FaceDetector import EmotionFacePredictor
+    efp = EmotionFacePredictor(os.getcwd(), args.cascade_dir, args.model)
+    efp.run_setup()
+    return efp
+
+
+def count_frames(video):
+    import cv2
+    vc, n_frames = cv2.VideoCapture(video), 0
+    while vc.read()[0]:
+        n_frames += 1
+    vc.release()
+    return n_frames
+
+
+def run_video(efp, video, **kwargs):
+    # classify_faces_video without displays, per-frame printing discarded; returns the saved predicts
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        efp.classify_faces_video(file_path=video, duration=0, output_name='bench_video',
+                                 show_plots=False, show_final_plot=False, **kwargs)
+    with open('../images/bench_video_predicts.txt') as f:
+        return f.read()
+
+
+def bench_video(args):
+    '''
+    Frames/sec of classify_faces_video: the serial per-frame loop against
+    cross-frame micro-batching and the threaded pipeline (same predictions)
+    '''
+    efp = face_predictor(args)
+    n_frames = count_frames(args.video)
+    print(f'{args.video}: {n_frames} frames')
+    modes = [('serial loop', {}),
+             ('micro-batched', {'batch_size': 32}),
+             ('pipeline, 2 detectors', {'n_detectors': 2, 'batch_size': 32}),
+             ('pipeline, 4 detectors', {'n_detectors': 4, 'batch_size': 32})]
+    reference = None
+    for name, kwargs in modes:
+        seconds, predicts = timed(run_video, efp, args.video, repeat=1, **kwargs)
+        reference = reference or predicts
+        assert predicts == reference, f'{name} predictions differ from the serial loop'
+        print(f'{name}: {n_frames / seconds:.1f} frames/sec')
+
+
+def face_detector(args):
+    # predictor with only the Haar cascade loaded (detection benchmarks need no model)
+    from FaceDetector import EmotionFacePredictor
+    efp = EmotionFacePredictor(os.getcwd(), args.cascade_dir, args.model)
+    efp.load_face_cascade()
+    return efp
+
+
+def gray_frames(video):
+    # every frame of a video, decoded and converted to gray up front (so decoding is not timed)
+    import cv2
+    vc, frames = cv2.VideoCapture(video), []
+    while True:
+        ret, frame = vc.read()
+        if not ret:
+            break
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    vc.release()
+    return frames
+
+
+def box_recall(reference, found, min_iou=0.5):
+    # fraction of the reference boxes (all frames) overlapped by a found box with IoU >= min_iou
+    from face_tracking import overlap
+    n_ref = sum(map(len, reference))
+    n_hit = sum(any(overlap(ref, box) >= min_iou for box in found_boxes)
+                for ref_boxes, found_boxes in zip(reference, found) for ref in ref_boxes)
+    return n_hit / n_ref if n_ref else 1.
+
+
+def bench_track(args):
+    '''
+    Tracking mode (FaceTracker): detection time, full detections and recall
+    of the full-detection boxes for several keyframe intervals
+    '''
+    from face_tracking import FaceTracker
+    efp = face_detector(args)
+    frames = gray_frames(args.video)
+    print(f'{args.video}: {len(frames)} frames')
+    seconds, reference = timed(lambda: [efp.detect_faces(gray) for gray in frames], repeat=1)
+    print(f'full detection every frame: {len(frames) / seconds:.1f} frames/sec')
+    for interval in (2, 5, 10, 25):
+        tracker = FaceTracker(efp.detect_faces, keyframe_interval=interval)
+        seconds, found = timed(lambda: [tracker(gray) for gray in frames], repeat=1)
+        report = tracker.report()
+        print(f'keyframe every {interval}: {len(frames) / seconds:.1f} frames/sec, '
+              f"{report['full_detections']} full detections ({report['full_detections_saved']} saved, "
+              f"{report['fallbacks']} fallbacks), {report['roi_searches']} local searches, "
+              f'recall {box_recall(reference, found):.3f}')
+
+
+def bench_detect(args):
+    '''
+    MultiResolutionDetector against the fixed full-resolution detectMultiScale
+    call (scaleFactor=1.1, minNeighbors=5, minSize=(30, 30)) on every video in
+    --videos, at native resolution and resized to --height rows (1080p
+    movies): frames/sec, faces found and agreement of the boxes
+    '''
+    import cv2
+    from face_tracking import MultiResolutionDetector
+    efp = face_detector(args)
+    multires = MultiResolutionDetector(efp.detect_faces)
+    for video in sorted(glob.glob(os.path.join(args.videos, '*'))):
+        native = gray_frames(video)
+        if not native:
+            continue
+        sizes = [('native', native)]
+        if native[0].shape[0] != args.height:
+            width = int(round(native[0].shape[1] * args.height / native[0].shape[0]))
+            sizes.append((f'{args.height}p', [cv2.resize(gray, (width, args.height)) for gray in native]))
+        for size, frames in sizes:
+            print(f'{os.path.basename(video)} ({size}, {frames[0].shape[1]}x{frames[0].shape[0]}, {len(frames)} frames)')
+            full_seconds, reference = timed(lambda: [efp.detect_faces(gray) for gray in frames], repeat=1)
+            seconds, found = timed(lambda: [multires(gray) for gray in frames], repeat=1)
+            print(f'  full resolution: {len(frames) / full_seconds:.1f} frames/sec, '
+                  f'{sum(map(len, reference))} faces')
+            print(f'  multi-resolution: {len(frames) / seconds:.1f} frames/sec ({full_seconds / seconds:.1f}x), '
+                  f'{sum(map(len, found))} faces, recall {box_recall(reference, found):.3f}, '
+                  f'precision {box_recall(found, reference):.3f}')
+
+
+BENCHMARKS = {'parse': bench_parse,
+              'cache': bench_cache,
+              'splits': bench_splits,
+              'decomposition': bench_decomposition,
+              'pipeline': bench_pipeline,
+              'evaluate': bench_evaluate,
+              'video': bench_video,
+              'track': bench_track,
+              'detect': bench_detect}
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--csv', default=None, help='path to fer2013.csv (synthetic data if omitted)')
+    parser.add_argument('--rows', type=int, default=35887, help='synthetic rows to generate')
+    parser.add_argument('--video', default='../stims/test_vids/test_2.webm', help='video for the video benchmarks')
+    parser.add_argument('--videos', default='../stims/test_vids', help='directory of videos for the detect benchmark')
+    parser.add_argument('--height', type=int, default=1080, help='frame height the detect benchmark also resizes to')
+    parser.add_argument('--model', default='CNN_cont.hdf5', help='trained model for the video benchmarks')
+    parser.add_argument('--cascade_dir', default=None, help='directory of haarcascade_frontalface_alt.xml (default: cv2.data)')
+    args = parser.parse_args()
+    if args.cascade_dir is None and args.benchmark in ('video', 'track', 'detect'):
+        import cv2
+        args.cascade_dir = cv2.data.haarcascades
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,72 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from keras.callbacks import Callback
+from keras.models import clone_model
+
+
+class BestWeightsCheckpoint(Callback):
+    '''
+    save_best_only checkpointing that keeps the best weights in memory
+
+    When the monitored metric improves the weights are copied (a host copy
+    of the variables, no serialization) and a background thread writes them
+    to filepath as a model file (architecture and weights, no optimizer
+    state; enough for load_model and predict), so training steps never wait
+    on disk. If several improvements queue up only the newest is written.
+    At the end of training the best weights are restored into the model,
+    which can be evaluated directly instead of being reloaded with load_model.
+    '''
+
+    def __init__(self, filepath, monitor='accuracy', mode='max', verbose=1):
+        super().__init__()
+        self.filepath = filepath
+        self.monitor = monitor
+        self.better = (lambda a, b: a > b) if mode == 'max' else (lambda a, b: a < b)
+        self.verbose = verbose
+        self.best = None
+        self.best_epoch = None
+        self.best_weights = None
+        self._version = 0 # newest weights handed to the writer
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+
+    def on_train_begin(self, logs=None):
+        # the writer serializes its own copy of the model, never the one being trained
+        self._shadow = clone_model(self.model)
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        # keras 2.3+ logs 'accuracy' where older versions logged 'acc'
+        value = logs.get(self.monitor, logs.get({'accuracy': 'acc', 'acc': 'accuracy'}.get(self.monitor)))
+        if value is None or (self.best is not None and not self.better(value, self.best)):
+            return
+        if self.verbose:
+            print(f'\nEpoch {epoch + 1}: {self.monitor} improved to {value:.5f}, keeping weights')
+        self.best, self.best_epoch = value, epoch
+        self.best_weights = self.model.get_weights()
+        with self._lock:
+            self._version += 1
+            version = self._version
+        self._pending.append(self._writer.submit(self._write, self.best_weights, version))
+
+    def _write(self, weights, version):
+        with self._lock:
+            if version != self._version: # superseded by a newer best while queued
+                return
+        root, ext = os.path.splitext(self.filepath)
+        tmp_path = root + '.tmp' + ext # same extension, so the same file format
+        self._shadow.set_weights(weights)
+        self._shadow.save(tmp_path)
+        os.replace(tmp_path, self.filepath)
+
+    def on_train_end(self, logs=None):
+        if self.best_weights is not None:
+            self.model.set_weights(self.best_weights)
+
+    def wait(self):
+        '''Block until the newest best weights are on disk (re-raises a failed write)'''
+        for future in self._pending:
+            future.result()
+        self._pending = []
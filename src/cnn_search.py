@@ -0,0 +1,103 @@
+import math
+import itertools
+import time
+import numpy as np
+import pandas as pd
+
+
+def effective_config(config, conditions):
+    # settings that do not apply to a configuration (see sample_configs) set to None
+    return {name: value if all(config[other] in allowed for other, allowed in conditions.get(name, {}).items()) else None
+            for name, value in config.items()}
+
+
+def sample_configs(space, n_configs, seed=1, conditions=None):
+    '''
+    Draw n_configs random configurations from a search space
+
+    Args:
+        space (dict): setting name -> list of candidate values
+        n_configs (int): number of configurations
+        seed (int): random seed
+        conditions (dict): setting name -> {other setting: values} it only applies with; in
+            other configurations it is None, so configurations that train the same model are
+            drawn once
+
+    Returns:
+        list of dict: distinct configurations (fewer if the space is smaller)
+        '''
+    conditions = conditions or {}
+    rng = np.random.RandomState(seed)
+    configs, seen = [], set()
+    n_combinations = len({repr(sorted(effective_config(dict(zip(space, values)), conditions).items()))
+                          for values in itertools.product(*space.values())})
+    while len(configs) < min(n_configs, n_combinations):
+        config = effective_config({name: values[rng.randint(len(values))] for name, values in space.items()},
+                                  conditions)
+        key = repr(sorted(config.items()))
+        if key not in seen:
+            seen.add(key)
+            configs.append(config)
+    return configs
+
+
+class SuccessiveHalving():
+    '''
+    Successive-halving search: train every configuration for min_epochs,
+    keep the best 1/eta by validation accuracy, train the survivors eta
+    times longer, and repeat until one configuration is left or max_epochs
+    is reached. Survivors keep training the same model (no restarts), so a
+    configuration's cost is only the epochs it actually earned.
+    '''
+
+    def __init__(self, build_fn, train_fn, configs, min_epochs=1, max_epochs=27, eta=3):
+        '''
+        Args:
+            build_fn (function): config -> compiled keras model
+            train_fn (function): (model, config, initial_epoch, epochs) -> validation accuracy
+            configs (list of dict): configurations to search
+            min_epochs (int): epochs every configuration gets in the first rung
+            max_epochs (int): epoch budget of the last rung
+            eta (int): 1/eta of the configurations are promoted each rung
+            '''
+        self.build_fn = build_fn
+        self.train_fn = train_fn
+        self.configs = configs
+        self.min_epochs = min_epochs
+        self.max_epochs = max_epochs
+        self.eta = eta
+
+    def run(self):
+        '''
+        Returns:
+            pd.DataFrame: one row per (configuration, rung) with epochs trained,
+            validation accuracy and cumulative wall-clock seconds
+            '''
+        rows = []
+        models = {i: None for i in range(len(self.configs))}
+        seconds = {i: 0. for i in models}
+        trained = {i: 0 for i in models}
+        survivors = list(models)
+        epochs, rung = self.min_epochs, 0
+        while survivors:
+            scores = {}
+            for i in survivors:
+                config = self.configs[i]
+                start = time.perf_counter()
+                if models[i] is None:
+                    models[i] = self.build_fn(config)
+                scores[i] = self.train_fn(models[i], config, trained[i], epochs)
+                seconds[i] += time.perf_counter() - start
+                trained[i] = epochs
+                rows.append(dict(config, config_id=i, rung=rung, epochs=epochs,
+                                 val_accuracy=scores[i], seconds=seconds[i]))
+                print(f'rung {rung} config {i} ({epochs} epochs): val accuracy {scores[i]:.3f}, {seconds[i]:.0f}s')
+            if len(survivors) == 1 or epochs >= self.max_epochs:
+                break
+            ranked = sorted(survivors, key=lambda i: -scores[i])
+            survivors = ranked[:max(1, math.ceil(len(survivors) / self.eta))]
+            for i in ranked[len(survivors):]:
+                models[i] = None # free the eliminated models
+            epochs, rung = min(epochs * self.eta, self.max_epochs), rung + 1
+        self.best_config = self.configs[max(survivors, key=lambda i: scores[i])]
+        return pd.DataFrame(rows)
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from fer_data import ingest_csvs, load_dataset, is_dataset
+
+
+def hash_params(params):
+    # stable hash of a json-able dict of preprocessing parameters
+    blob = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.sha1(blob).hexdigest()[:16]
+
+
+class DatasetCache():
+    '''
+    Content-addressed cache of processed datasets and their variants
+
+    Layout of root:
+        hashes.json                       file hash memo keyed on (path, size, mtime)
+        <source_key>/                     decoded images for one set of source csvs
+            images.npy, emotion.npy, ...  (see fer_data.save_dataset)
+            variants/<params_key>/        arrays derived with one set of parameters
+                params.json, <name>.npy
+
+    source_key hashes the contents of the source csvs, so an edited csv gets
+    a new entry instead of a stale hit. Variants (label mapping, balancing
+    seed, ...) sit side by side under their source. When the cache grows
+    past max_bytes the least recently used entries are evicted.
+    '''
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes # None = unlimited
+        os.makedirs(self.root, exist_ok=True)
+
+    def source_key(self, csv_paths):
+        return hash_params([self.hash_file(path) for path in csv_paths])
+
+    def hash_file(self, path, block_size=1<<20):
+        '''sha1 of a file, memoized while its size and mtime are unchanged'''
+        memo_path = os.path.join(self.root, 'hashes.json')
+        memo = {}
+        if os.path.isfile(memo_path):
+            with open(memo_path) as f:
+                memo = json.load(f)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        entry = memo.get(os.path.abspath(path))
+        if entry and entry['stamp'] == stamp:
+            return entry['sha1']
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        memo[os.path.abspath(path)] = {'stamp': stamp, 'sha1': sha.hexdigest()}
+        with open(memo_path, 'w') as f:
+            json.dump(memo, f)
+        return sha.hexdigest()
+
+    def load_source(self, csv_paths, chunk_size=4096):
+        '''
+        Open the decoded dataset for csv_paths, ingesting it on a miss
+
+        Returns:
+            images, labels, meta (see fer_data.load_dataset) and the source key
+            '''
+        key = self.source_key(csv_paths)
+        entry = os.path.join(self.root, key)
+        if not is_dataset(entry):
+            print(f'No processed data for {key}, converting strings to arrays')
+            ingest_csvs(csv_paths, entry, chunk_size=chunk_size)
+        else:
+            print(f'Processed data found: {key}')
+        self.touch(entry)
+        self.evict(keep=[entry])
+        images, labels, meta = load_dataset(entry)
+        return images, labels, meta, key
+
+    def variant(self, source_key, params):
+        path = os.path.join(self.root, source_key, 'variants', hash_params(params))
+        return CacheVariant(self, path, params)
+
+    @staticmethod
+    def touch(path):
+        # record a use of a cache entry for LRU eviction
+        with open(os.path.join(path, 'last_used'), 'w') as f:
+            f.write(str(time.time()))
+
+    @staticmethod
+    def last_used(path):
+        try:
+            with open(os.path.join(path, 'last_used')) as f:
+                return float(f.read())
+        except (OSError, ValueError):
+            return 0.
+
+    @staticmethod
+    def dir_bytes(path, skip=None):
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            if skip in dirnames:
+                dirnames.remove(skip)
+            total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+        return total
+
+    def entries(self):
+        '''(path, bytes, last_used) for every source and variant entry'''
+        found = []
+        for key in os.listdir(self.root):
+            source = os.path.join(self.root, key)
+            if not os.path.isdir(source) or source.endswith('.tmp'):
+                continue
+            found.append((source, self.dir_bytes(source, skip='variants'), self.last_used(source)))
+            variants = os.path.join(source, 'variants')
+            if os.path.isdir(variants):
+                for name in os.listdir(variants):
+                    path = os.path.join(variants, name)
+                    found.append((path, self.dir_bytes(path), self.last_used(path)))
+        return found
+
+    def evict(self, keep=()):
+        '''Remove least recently used entries until the cache fits in max_bytes'''
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        keep = [os.path.abspath(k) for k in keep]
+        for path, n_bytes, _ in entries:
+            if total <= self.max_bytes:
+                break
+            path = os.path.abspath(path)
+            # never evict an entry in use or the source of one
+            if any(k == path or k.startswith(path + os.sep) for k in keep) or not os.path.isdir(path):
+                continue
+            print(f'Evicting {path} from dataset cache')
+            if os.path.basename(os.path.dirname(path)) == 'variants':
+                total -= n_bytes
+            else: # a source takes its variants with it
+                total -= self.dir_bytes(path)
+            shutil.rmtree(path)
+
+
+class CacheVariant():
+    '''Named arrays derived from a source dataset with one set of parameters'''
+
+    def __init__(self, cache, path, params):
+        self.cache = cache
+        self.path = path
+        self.params = params
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def _tmp_file(self, name):
+        # per-process temporary file, so concurrent writers of one variant never share it
+        return os.path.join(self.path, f'{name}.{os.getpid()}.tmp.npy')
+
+    def get(self, name, mmap_mode=None):
+        '''Stored array (memory-mapped if mmap_mode is given) or None'''
+        if not os.path.isfile(self._file(name)):
+            return None
+        self.cache.touch(self.path)
+        return np.load(self._file(name), mmap_mode=mmap_mode)
+
+    def _prepare(self):
+        os.makedirs(self.path, exist_ok=True)
+        params_file = os.path.join(self.path, 'params.json')
+        if not os.path.isfile(params_file):
+            tmp_file = f'{params_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self.params, f, sort_keys=True, default=str)
+            os.replace(tmp_file, params_file)
+
+    def _publish(self, name):
+        # move a finished temporary file into place (the last of concurrent writers wins, all write the same array)
+        os.replace(self._tmp_file(name), self._file(name))
+        self.cache.touch(self.path)
+        self.cache.evict(keep=[self.path])
+
+    def put(self, name, arr):
+        self._prepare()
+        np.save(self._tmp_file(name), arr)
+        self._publish(name)
+
+    def create(self, name, shape, dtype):
+        '''
+        Writable memory-mapped array for an array too large to build in
+        memory; fill it, then store it with finish(name, arr)
+        '''
+        self._prepare()
+        return np.lib.format.open_memmap(self._tmp_file(name), mode='w+', dtype=dtype, shape=shape)
+
+    def finish(self, name, arr):
+        arr.flush()
+        del arr
+        self._publish(name)
@@ -0,0 +1,117 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from sklearn import decomposition
+from threadpoolctl import threadpool_limits
+from fer_data import shared_images, open_shared_images
+
+
+def _group_matrix(images, rows):
+    # (n, 2304) float32 matrix of the rows of one group
+    return np.asarray(images[rows], dtype=np.float32).reshape(len(rows), -1)
+
+
+def _batches(rows, batch_size, min_size, rng=None):
+    '''
+    Yield sorted row batches (sorted for sequential reads from a memmap),
+    shuffled first if rng is given; a final batch smaller than min_size is
+    folded into the previous one
+    '''
+    if rng is not None:
+        rows = rows[rng.permutation(len(rows))]
+    bounds = list(range(0, len(rows), batch_size)) + [len(rows)]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < min_size:
+        del bounds[-2]
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        yield np.sort(rows[start:stop])
+
+
+def _fit_nmf(source, rows, n_components, seed, batch_size=None, n_passes=1):
+    # worker: one NMF fit, single-threaded BLAS so workers don't oversubscribe cores
+    images = open_shared_images(source)
+    with threadpool_limits(limits=1):
+        if batch_size is None:
+            nmf = decomposition.NMF(n_components=n_components, random_state=seed)
+            nmf.fit(_group_matrix(images, rows))
+        else:
+            rng = np.random.RandomState(seed)
+            nmf = decomposition.MiniBatchNMF(n_components=n_components, batch_size=batch_size, random_state=seed)
+            for _ in range(n_passes):
+                for batch in _batches(rows, batch_size, n_components, rng):
+                    nmf.partial_fit(_group_matrix(images, batch))
+    return nmf.components_.mean(0)
+
+
+class DecompositionComparison():
+    '''
+    Mean PCA/NMF component images for several groups of rows at several
+    component counts (e.g. self.values = [1, 3, 5, 10])
+
+    PCA components are nested (the k component solution is the first k
+    components of any larger solution), so PCA is fitted once per group at
+    max(values) and sliced. NMF solutions are not nested, so every
+    (group, n_components) pair is fitted, concurrently in a process pool
+    over the shared image buffer.
+
+    With batch_size set, fits are out-of-core: IncrementalPCA and
+    MiniBatchNMF are fed float32 batches of batch_size rows read from the
+    image buffer, so memory stays bounded by the batch, not the group size.
+    '''
+
+    def __init__(self, images, groups, values, n_jobs=None, seed=1, batch_size=None, n_passes=5):
+        '''
+        Args:
+            images (np.ndarray or np.memmap): (N, 48, 48) image buffer
+            groups (dict): group name -> row positions into images
+            values (list of int): component counts to compare
+            n_jobs (int): NMF worker processes (None = all cores)
+            seed (int): random state for the fits
+            batch_size (int): rows per batch for streaming fits (None = fit each group in memory)
+            n_passes (int): passes over each group for streaming NMF
+            '''
+        self.images = images
+        self.groups = groups
+        self.values = sorted(values)
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.seed = seed
+        self.batch_size = batch_size
+        self.n_passes = n_passes
+        self.timings = {}
+
+    def pca_components(self):
+        '''{group: {n_components: mean component (2304,)}}'''
+        start = time.perf_counter()
+        results = {}
+        n_components = self.values[-1]
+        for name, rows in self.groups.items():
+            if self.batch_size is None:
+                pca = decomposition.PCA(n_components=n_components, random_state=self.seed)
+                pca.fit(_group_matrix(self.images, rows))
+            else:
+                pca = decomposition.IncrementalPCA(n_components=n_components)
+                for batch in _batches(rows, self.batch_size, n_components):
+                    pca.partial_fit(_group_matrix(self.images, batch))
+            results[name] = {val: pca.components_[:val].mean(0) for val in self.values}
+        self.timings['pca'] = time.perf_counter() - start
+        return results
+
+    def nmf_components(self):
+        '''{group: {n_components: mean component (2304,)}}'''
+        start = time.perf_counter()
+        # largest fits first so the pool isn't left waiting on one long task
+        tasks = sorted(((name, val) for name in self.groups for val in self.values),
+                       key=lambda task: -task[1] * len(self.groups[task[0]]))
+        if self.n_jobs == 1: # no pool overhead when there is nothing to parallelize
+            fitted = {task: _fit_nmf(self.images, self.groups[task[0]], task[1], self.seed,
+                                     self.batch_size, self.n_passes) for task in tasks}
+        else:
+            source = shared_images(self.images)
+            with ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=get_context('spawn')) as pool:
+                futures = {task: pool.submit(_fit_nmf, source, self.groups[task[0]], task[1], self.seed,
+                                             self.batch_size, self.n_passes) for task in tasks}
+                fitted = {task: future.result() for task, future in futures.items()}
+        results = {name: {val: fitted[(name, val)] for val in self.values} for name in self.groups}
+        self.timings['nmf'] = time.perf_counter() - start
+        return results
@@ -0,0 +1,92 @@
+import numpy as np
+from input_pipeline import make_dataset
+
+
+class Evaluation():
+    '''
+    Predicted classes, accuracy, log loss and confusion matrix of one split,
+    all derived from the predicted probabilities and accumulated one chunk
+    at a time (so a split never has to be predicted in one piece)
+
+    Probability columns are the class labels 0..n_classes-1.
+    '''
+
+    def __init__(self, n_classes, keep_proba=True, eps=1e-15):
+        self.n_classes = n_classes
+        self.keep_proba = keep_proba # False keeps only classes and running totals
+        self.eps = eps # probability clipping, as sklearn.metrics.log_loss
+        self.confusion = np.zeros((n_classes, n_classes), dtype=np.int64)
+        self.loss_sum = 0.
+        self._pred = []
+        self._proba = []
+
+    @classmethod
+    def from_proba(cls, y, proba, **kwargs):
+        # evaluation of probabilities that are already in memory (e.g. sklearn predict_proba)
+        evaluation = cls(proba.shape[1], **kwargs)
+        evaluation.update(y, proba)
+        return evaluation
+
+    def update(self, y, proba):
+        '''
+        Args:
+            y (np.ndarray): labels, sparse or one-hot
+            proba (np.ndarray): (n, n_classes) predicted probabilities
+            '''
+        y = np.asarray(y)
+        if y.ndim == 2:
+            y = y.argmax(1)
+        proba = np.asarray(proba, dtype=np.float64)
+        pred = proba.argmax(1)
+        self.confusion += np.bincount(y * self.n_classes + pred,
+                                      minlength=self.n_classes**2).reshape(self.n_classes, self.n_classes)
+        # log_loss: clip, renormalize each row, -log p(true class)
+        clipped = np.clip(proba, self.eps, 1 - self.eps)
+        self.loss_sum -= np.log(clipped[np.arange(len(y)), y] / clipped.sum(1)).sum()
+        self._pred.append(pred)
+        if self.keep_proba:
+            self._proba.append(proba)
+
+    @property
+    def n(self):
+        return int(self.confusion.sum())
+
+    @property
+    def accuracy(self):
+        return np.trace(self.confusion) / self.n
+
+    @property
+    def log_loss(self):
+        return self.loss_sum / self.n
+
+    @property
+    def pred(self):
+        return np.concatenate(self._pred)
+
+    @property
+    def proba(self):
+        return np.concatenate(self._proba) if self.keep_proba else None
+
+
+def evaluate_model(model, x, y, n_classes, batch_size=512, keep_proba=True, **dataset_args):
+    '''
+    One batched forward pass of a keras model over a split, streamed through
+    the tf.data pipeline: make_dataset(cache=False) reads each batch from x
+    in place (gather_rows), so only the batches in flight are in memory
+
+    Args:
+        model: trained keras model with softmax output
+        x (array-like): uint8 images (np.ndarray or ImageView)
+        y (np.ndarray): labels, sparse or one-hot
+        n_classes (int): number of classes
+        batch_size (int): images per forward pass
+        keep_proba (bool): keep the (n, n_classes) probabilities
+        dataset_args: make_dataset arguments (preprocess_fn; cache is always off, one pass has nothing to reuse)
+
+    Returns:
+        Evaluation
+        '''
+    evaluation = Evaluation(n_classes, keep_proba=keep_proba)
+    for x_batch, y_batch in make_dataset(x, y, batch_size, **dict(dataset_args, cache=False)):
+        evaluation.update(y_batch.numpy(), model.predict_on_batch(x_batch))
+    return evaluation
@@ -0,0 +1,165 @@
+import cv2
+import numpy as np
+
+
+def search_region(detect, gray, box, margin=0.5, size_range=(0.7, 1.4)):
+    '''
+    Full-resolution detection in the region around a box
+
+    Args:
+        detect (function): (gray, **detectMultiScale overrides) -> (n, 4) x, y, w, h boxes
+        gray (np.ndarray): gray frame
+        box (array-like): x, y, w, h of the face to look for
+        margin (float): region padding around the box, in box sizes
+        size_range (tuple): min/max face size, relative to the box
+
+    Returns:
+        np.ndarray: the detection closest to the box center, in frame coordinates (None if nothing was found)
+        '''
+    x, y, w, h = box
+    pad_x, pad_y = int(margin * w), int(margin * h)
+    x0, y0 = max(0, x - pad_x), max(0, y - pad_y)
+    x1, y1 = min(gray.shape[1], x + w + pad_x), min(gray.shape[0], y + h + pad_y)
+    lo, hi = size_range
+    found = detect(gray[y0:y1, x0:x1],
+                   minSize=(int(w * lo), int(h * lo)),
+                   maxSize=(int(w * hi), int(h * hi)))
+    if len(found) == 0:
+        return None
+    found = np.asarray(found) + [x0, y0, 0, 0] # back to frame coordinates
+    centers = found[:, :2] + found[:, 2:] / 2
+    return found[np.argmin(((centers - (x + w / 2, y + h / 2))**2).sum(1))]
+
+
+def overlap(a, b):
+    # intersection over union of two x, y, w, h boxes
+    iw = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    ih = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    return iw * ih / (a[2] * a[3] + b[2] * b[3] - iw * ih)
+
+
+class MultiResolutionDetector():
+    '''
+    Two-step face detection for large frames
+
+    The smallest face looked for is min_face_fraction of the frame height
+    (30 px on 480 rows, the fixed minSize used so far), at least 30 px. The
+    gray frame is downscaled so that this face is search_face px, searched
+    for candidates (with candidate_neighbors, permissive, so few faces are
+    missed), and every candidate is confirmed in a small full-resolution
+    region around it (search_region, with the detector's own minNeighbors).
+    Boxes come back in original frame coordinates.
+
+    Small frames (up to 480 rows, where the smallest face is the 30 px floor,
+    or whenever the downscale would be above max_scale) are detected directly
+    at full resolution with the derived minSize: one call there is cheaper
+    than a downscaled pass plus a refinement per candidate. On 1080p frames
+    the full-resolution pyramid is replaced by one about a third of the size
+    plus a handful of face-sized regions.
+    '''
+
+    def __init__(self, detect, min_face_fraction=1/16, search_face=24, candidate_neighbors=3,
+                 margin=0.25, size_range=(0.7, 1.4), max_scale=0.6):
+        '''
+        Args:
+            detect (function): (gray, **detectMultiScale overrides) -> (n, 4) x, y, w, h boxes
+            min_face_fraction (float): smallest face, relative to the frame height
+            search_face (int): size of the smallest face on the downscaled frame (>= the 20 px cascade window)
+            candidate_neighbors (int): minNeighbors of the downscaled search
+            margin (float): refinement region padding around a candidate, in box sizes
+            size_range (tuple): min/max refined face size, relative to the candidate
+            max_scale (float): largest downscale worth a two-step detection
+            '''
+        self.detect = detect
+        self.min_face_fraction = min_face_fraction
+        self.search_face = search_face
+        self.candidate_neighbors = candidate_neighbors
+        self.margin = margin
+        self.size_range = size_range
+        self.max_scale = max_scale
+
+    def __call__(self, gray):
+        '''Face boxes in a gray frame, full-frame (x, y, w, h) coordinates'''
+        min_face = max(30, int(round(self.min_face_fraction * gray.shape[0])))
+        scale = self.search_face / min_face
+        if min_face == 30 or scale > self.max_scale:
+            return self.detect(gray, minSize=(min_face, min_face))
+        small = cv2.resize(gray, (int(gray.shape[1] * scale), int(gray.shape[0] * scale)),
+                           interpolation=cv2.INTER_AREA)
+        candidates = self.detect(small, minNeighbors=self.candidate_neighbors,
+                                 minSize=(self.search_face, self.search_face))
+        faces = []
+        for box in np.asarray(candidates, dtype=np.float64).reshape(-1, 4) / scale:
+            face = search_region(self.detect, gray, box.round().astype(np.int64), self.margin, self.size_range)
+            if face is not None and all(overlap(face, kept) < 0.5 for kept in faces): # two candidates, one face
+                faces.append(face)
+        return np.array(faces, dtype=np.int64).reshape(-1, 4)
+
+
+class FaceTracker():
+    '''
+    Detect-every-N-frames face tracking
+
+    Full-frame detection only runs on keyframes (every keyframe_interval
+    frames). In between, each face found on the previous frame is searched
+    for in a region around its box (margin box sizes on each side, face
+    sizes limited to size_range times the previous size), which is a small
+    fraction of the full-frame cost. When fewer than min_found of the
+    tracked faces are found again the frame falls back to full detection.
+
+    keyframe_interval trades recall for speed: faces that enter the frame
+    between keyframes are picked up at the next keyframe, up to
+    keyframe_interval - 1 frames late (1 = detect every frame, as before).
+    '''
+
+    def __init__(self, detect, keyframe_interval=5, margin=0.5, size_range=(0.7, 1.4), min_found=1.0,
+                 keyframe_detect=None):
+        '''
+        Args:
+            detect (function): (gray, **detectMultiScale overrides) -> (n, 4) x, y, w, h boxes
+            keyframe_interval (int): frames between full detections
+            margin (float): search region padding around a box, in box sizes
+            size_range (tuple): min/max face size in a search region, relative to the previous box
+            min_found (float): fraction of tracked faces that must be found again
+            keyframe_detect (function): gray -> boxes, full-frame detection (default: detect)
+            '''
+        self.detect = detect
+        self.keyframe_detect = detect if keyframe_detect is None else keyframe_detect
+        self.keyframe_interval = keyframe_interval
+        self.margin = margin
+        self.size_range = size_range
+        self.min_found = min_found
+        self.boxes = np.empty((0, 4), dtype=np.int64)
+        self.frames = 0
+        self.full_detections = 0
+        self.fallbacks = 0 # full detections forced by lost faces
+        self.roi_searches = 0
+
+    def __call__(self, gray):
+        '''Face boxes in a gray frame, full-frame (x, y, w, h) coordinates'''
+        keyframe = self.frames % self.keyframe_interval == 0
+        self.frames += 1
+        if not keyframe and len(self.boxes):
+            tracked = [box for box in (self.search(gray, box) for box in self.boxes) if box is not None]
+            if len(tracked) >= self.min_found * len(self.boxes):
+                self.boxes = np.array(tracked, dtype=np.int64).reshape(-1, 4)
+                return self.boxes
+            self.fallbacks += 1
+        elif not keyframe: # nothing to track until the next keyframe
+            return self.boxes
+        self.full_detections += 1
+        self.boxes = np.array(self.keyframe_detect(gray), dtype=np.int64).reshape(-1, 4)
+        return self.boxes
+
+    def search(self, gray, box):
+        # best detection in the region around a previous box, None if the face is lost
+        self.roi_searches += 1
+        return search_region(self.detect, gray, box, self.margin, self.size_range)
+
+    def report(self):
+        '''Detector usage: full detections, region searches and full detections saved'''
+        return {'frames': self.frames,
+                'full_detections': self.full_detections,
+                'fallbacks': self.fallbacks,
+                'roi_searches': self.roi_searches,
+                'full_detections_saved': self.frames - self.full_detections}
@@ -0,0 +1,193 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+
+IMG_SHAPE = (48, 48) # FER2013 images are 48x48 grayscale
+IMG_SIZE = IMG_SHAPE[0] * IMG_SHAPE[1]
+
+
+def parse_pixels(pixels, out=None, chunk_size=None):
+    """
+    Parse a column of space separated pixel strings into one uint8 array
+
+    Each chunk of rows is joined into a single string and decoded by numpy in
+    one C-level pass, so no per-row python ints or intermediate lists are built.
+
+    Args:
+        pixels (pd.Series or sequence of str): FER2013 'pixels' column
+        out (np.ndarray): optional (N, 48, 48) uint8 array (or memmap) to fill
+        chunk_size (int): rows decoded per pass (None = all rows at once)
+
+    Returns:
+        np.ndarray: (N, 48, 48) uint8 array of images
+        """
+    pixels = getattr(pixels, 'values', pixels) # accept Series or list
+    n_rows = len(pixels)
+    if out is None:
+        out = np.empty((n_rows,) + IMG_SHAPE, dtype=np.uint8)
+    elif out.shape != (n_rows,) + IMG_SHAPE:
+        raise ValueError(f'out has shape {out.shape}, expected {(n_rows,) + IMG_SHAPE}')
+    flat_out = out.reshape(n_rows, IMG_SIZE) # view, writes land in out
+    chunk_size = chunk_size or max(n_rows, 1)
+    for start in range(0, n_rows, chunk_size):
+        stop = min(start + chunk_size, n_rows)
+        values = np.fromstring(' '.join(pixels[start:stop]), dtype=np.uint8, sep=' ')
+        if values.size != (stop - start) * IMG_SIZE:
+            raise ValueError(f'Rows {start}-{stop} do not contain {IMG_SIZE} pixels each')
+        flat_out[start:stop] = values.reshape(stop - start, IMG_SIZE)
+    return out
+
+
+CACHE_VERSION = 1
+
+
+def save_dataset(cache_dir, images, emotion, usage):
+    """
+    Write a processed dataset as a memory-mappable binary cache
+
+    Layout of cache_dir:
+        images.npy  (N, 48, 48) uint8
+        emotion.npy (N,) int8 labels
+        usage.npy   (N,) int8 codes into meta['usage_categories']
+        meta.json   version, row count, image shape, usage categories
+
+    Files are written to a temporary directory first and moved into place, so
+    a crashed save never leaves a half-written cache behind.
+
+    Args:
+        cache_dir (str): directory to write
+        images (np.ndarray): (N, 48, 48) uint8 images
+        emotion (array-like): (N,) integer labels
+        usage (array-like): (N,) 'Usage' strings (Training/PublicTest/PrivateTest)
+        """
+    tmp_dir = _make_tmp_dir(cache_dir)
+    np.save(os.path.join(tmp_dir, 'images.npy'), np.ascontiguousarray(images, dtype=np.uint8))
+    usage = pd.Categorical(usage)
+    _finish_dataset(tmp_dir, cache_dir, emotion, usage.codes, list(usage.categories))
+
+
+def ingest_csvs(csv_paths, cache_dir, chunk_size=4096):
+    """
+    Stream one or more FER2013-format csvs into a dataset cache
+
+    Rows are read chunk_size at a time and their pixels decoded straight into
+    a preallocated on-disk images.npy, so peak memory is one chunk of strings
+    plus the label columns, regardless of how many images there are.
+
+    Args:
+        csv_paths (list of str): csvs with 'emotion', 'pixels' and 'Usage' columns,
+            concatenated in order
+        cache_dir (str): directory to write (same layout as save_dataset)
+        chunk_size (int): csv rows read and decoded per chunk
+
+    Returns:
+        int: number of images written
+        """
+    n_rows = sum(count_rows(path) for path in csv_paths)
+    tmp_dir = _make_tmp_dir(cache_dir)
+    images = np.lib.format.open_memmap(os.path.join(tmp_dir, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(n_rows,) + IMG_SHAPE)
+    emotion = np.empty(n_rows, dtype=np.int8)
+    usage = np.empty(n_rows, dtype=np.int8)
+    usage_categories = [] # 'Usage' strings in order of first appearance
+    pos = 0
+    for path in csv_paths:
+        print(f'Ingesting {path}')
+        for chunk in pd.read_csv(path, usecols=['emotion', 'pixels', 'Usage'], chunksize=chunk_size):
+            stop = pos + len(chunk)
+            if stop > n_rows:
+                raise ValueError(f'{path} has more rows than counted ({n_rows})')
+            parse_pixels(chunk['pixels'], out=images[pos:stop])
+            emotion[pos:stop] = chunk['emotion'].values
+            codes, uniques = pd.factorize(chunk['Usage'])
+            for name in uniques:
+                if name not in usage_categories:
+                    usage_categories.append(name)
+            usage[pos:stop] = np.array([usage_categories.index(name) for name in uniques])[codes]
+            pos = stop
+    if pos != n_rows:
+        raise ValueError(f'Read {pos} rows but counted {n_rows}')
+    images.flush()
+    del images # close the memmap before the directory is moved
+    _finish_dataset(tmp_dir, cache_dir, emotion, usage, usage_categories)
+    return n_rows
+
+
+def count_rows(csv_path):
+    # data rows in a csv without quoted newlines (header excluded)
+    with open(csv_path, 'rb') as f:
+        return sum(1 for line in f if line.strip()) - 1
+
+
+def _make_tmp_dir(cache_dir):
+    tmp_dir = cache_dir + '.tmp'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    return tmp_dir
+
+
+def _finish_dataset(tmp_dir, cache_dir, emotion, usage_codes, usage_categories):
+    # write labels and header next to tmp_dir/images.npy, then move into place
+    np.save(os.path.join(tmp_dir, 'emotion.npy'), np.asarray(emotion, dtype=np.int8))
+    np.save(os.path.join(tmp_dir, 'usage.npy'), np.asarray(usage_codes, dtype=np.int8))
+    meta = {'version': CACHE_VERSION,
+            'n_rows': int(len(usage_codes)),
+            'img_shape': list(IMG_SHAPE),
+            'usage_categories': list(usage_categories)}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+
+def is_dataset(cache_dir):
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path) as f:
+        return json.load(f).get('version') == CACHE_VERSION
+
+
+def load_dataset(cache_dir, mmap_mode='r'):
+    """
+    Open a cache written by save_dataset
+
+    Images are memory-mapped read-only by default, so opening is O(1) and
+    every process reading the same cache shares its pages via the OS page cache.
+
+    Returns:
+        images (np.ndarray or np.memmap): (N, 48, 48) uint8
+        labels (pd.DataFrame): 'emotion' and categorical 'Usage' columns
+        meta (dict): metadata header
+        """
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode=mmap_mode)
+    emotion = np.load(os.path.join(cache_dir, 'emotion.npy'))
+    usage = np.load(os.path.join(cache_dir, 'usage.npy'))
+    labels = pd.DataFrame({'emotion': emotion.astype(np.int64),
+                           'Usage': pd.Categorical.from_codes(usage, meta['usage_categories'])})
+    return images, labels, meta
+
+
+def shared_images(images):
+    '''
+    What to send to worker processes for an image buffer: the .npy path of a
+    memmap (workers map the same pages) or the array itself (pickled per task)
+    '''
+    filename = getattr(images, 'filename', None)
+    if filename is not None and os.path.isfile(filename):
+        return str(filename)
+    return np.asarray(images)
+
+
+def open_shared_images(source):
+    # inverse of shared_images, called in the worker
+    if isinstance(source, str):
+        return np.load(source, mmap_mode='r')
+    return source
@@ -0,0 +1,107 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from threadpoolctl import threadpool_limits
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import accuracy_score, log_loss
+from fer_data import shared_images, open_shared_images
+
+
+def fit_flat_model(source, model, params, train_rows, y_train, test_rows, sample_weight=None, n_threads=1):
+    '''
+    Fit one sklearn model on flattened images and predict train and test
+
+    Args:
+        source: image buffer or its shared_images() handle
+        model (class): sklearn classifier class
+        params (dict): keyword arguments for model
+        train_rows, test_rows (np.ndarray): row positions into the image buffer
+        y_train (np.ndarray): labels of train_rows
+        sample_weight (np.ndarray): per-row weights of train_rows (e.g. class balancing), None = equal
+        n_threads (int): BLAS (and model n_jobs) threads for this fit
+
+    Returns:
+        train_pred_y, train_pred_proba, test_pred_y, test_pred_proba
+        '''
+    images = open_shared_images(source)
+    x_train = images[train_rows].reshape(len(train_rows), -1)
+    x_test = images[test_rows].reshape(len(test_rows), -1)
+    params = dict(params)
+    if 'n_jobs' in model().get_params(): # e.g. RandomForest's tree-building threads
+        params.setdefault('n_jobs', n_threads)
+    with threadpool_limits(limits=n_threads):
+        fitted = model(**params).fit(x_train, y_train, sample_weight=sample_weight)
+        train_pred_proba = fitted.predict_proba(x_train)
+        test_pred_proba = fitted.predict_proba(x_test)
+    # predict() is the argmax of predict_proba for these models
+    train_pred_y = fitted.classes_[train_pred_proba.argmax(1)]
+    test_pred_y = fitted.classes_[test_pred_proba.argmax(1)]
+    return train_pred_y, train_pred_proba, test_pred_y, test_pred_proba
+
+
+def run_flat_grid(images, tasks, n_jobs=None):
+    '''
+    Fit a grid of flat models concurrently, one process per fit
+
+    Workers re-open a memory-mapped image buffer from its path, so the
+    training data is shared through the page cache instead of being pickled
+    to every worker; only index and label arrays are sent.
+
+    Args:
+        images (np.ndarray or np.memmap): (N, 48, 48) image buffer
+        tasks (list of dict): each with 'model', 'params', 'train_rows',
+            'y_train', 'test_rows' and optionally 'sample_weight' (see fit_flat_model)
+        n_jobs (int): worker processes (None = all cores)
+
+    Returns:
+        list: fit_flat_model results, in the order of tasks
+        '''
+    n_cores = os.cpu_count()
+    n_jobs = min(n_jobs or n_cores, len(tasks))
+    n_threads = max(1, n_cores // n_jobs) # split cores between concurrent fits
+    if n_jobs <= 1:
+        return [fit_flat_model(images, n_threads=n_threads, **task) for task in tasks]
+    source = shared_images(images)
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=get_context('spawn')) as pool:
+        futures = [pool.submit(fit_flat_model, source, n_threads=n_threads, **task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def sweep_forest(source, params, train_rows, y_train, val_rows, y_val, test_rows, y_test,
+                 checkpoints=(50, 100, 200, 500), min_gain=0.005, sample_weight=None, n_jobs=None):
+    '''
+    Grow one RandomForest with warm_start through increasing tree counts
+
+    Each checkpoint only fits the new trees. The sweep stops once validation
+    log loss improves by less than min_gain over the previous checkpoint.
+    Trees are built on n_jobs threads (None = all cores) unless params sets n_jobs.
+
+    Returns:
+        list of dict: per checkpoint 'Trees', train/test accuracy and log loss
+        '''
+    images = open_shared_images(source)
+    x = {name: images[rows].reshape(len(rows), -1)
+         for name, rows in [('train', train_rows), ('val', val_rows), ('test', test_rows)]}
+    params = dict(params)
+    params.setdefault('n_jobs', n_jobs or os.cpu_count())
+    forest = RandomForestClassifier(warm_start=True, **params)
+    curve = []
+    prev_val_loss = np.inf
+    for n_trees in sorted(checkpoints):
+        forest.set_params(n_estimators=n_trees)
+        forest.fit(x['train'], y_train, sample_weight=sample_weight) # adds n_trees - len(forest.estimators_) trees
+        probas = {name: forest.predict_proba(x[name]) for name in x}
+        preds = {name: forest.classes_[proba.argmax(1)] for name, proba in probas.items()}
+        curve.append({'Trees': n_trees,
+                      'Train Accuracy': accuracy_score(y_train, preds['train']),
+                      'Train Log Loss': log_loss(y_train, probas['train'], labels=forest.classes_),
+                      'Test Accuracy': accuracy_score(y_test, preds['test']),
+                      'Test Log Loss': log_loss(y_test, probas['test'], labels=forest.classes_)})
+        val_loss = log_loss(y_val, probas['val'], labels=forest.classes_)
+        print(f"{n_trees} trees: val log loss {val_loss:.4f}, test accuracy {curve[-1]['Test Accuracy']:.3f}")
+        if prev_val_loss - val_loss < min_gain:
+            print(f'Log loss plateaued at {n_trees} trees')
+            break
+        prev_val_loss = val_loss
+    return curve
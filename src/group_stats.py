@@ -0,0 +1,74 @@
+import numpy as np
+
+
+class GroupedStats():
+    '''
+    Per-class count, mean, variance, min and max of images, accumulated in
+    one vectorized pass per chunk (so it also works on streamed chunks)
+
+    Sums are a one-hot (n, k) matrix product with the chunk, min/max are
+    segment reductions over the chunk sorted by label; no per-class loops
+    or boolean masks over the data.
+    '''
+
+    def __init__(self, n_groups, img_shape=(48, 48)):
+        self.n_groups = n_groups
+        self.img_shape = tuple(img_shape)
+        n_features = int(np.prod(img_shape))
+        self.count = np.zeros(n_groups, dtype=np.int64)
+        self._sum = np.zeros((n_groups, n_features))
+        self._sumsq = np.zeros((n_groups, n_features))
+        self.min = np.full((n_groups, n_features), np.inf)
+        self.max = np.full((n_groups, n_features), -np.inf)
+
+    def update(self, x, labels):
+        '''Add a chunk of images x (n, ...) with integer labels (n,) in [0, n_groups)'''
+        labels = np.asarray(labels)
+        x = np.asarray(x, dtype=np.float64).reshape(len(labels), -1)
+        one_hot = np.zeros((len(labels), self.n_groups))
+        one_hot[np.arange(len(labels)), labels] = 1
+        self.count += np.bincount(labels, minlength=self.n_groups)
+        self._sum += one_hot.T @ x
+        self._sumsq += one_hot.T @ np.square(x)
+        order = np.argsort(labels, kind='stable')
+        present, starts = np.unique(labels[order], return_index=True)
+        sorted_x = x[order]
+        self.min[present] = np.minimum(self.min[present], np.minimum.reduceat(sorted_x, starts))
+        self.max[present] = np.maximum(self.max[present], np.maximum.reduceat(sorted_x, starts))
+        return self
+
+    @classmethod
+    def from_images(cls, images, rows, labels, n_groups, chunk_size=4096):
+        '''
+        Stats of images[rows] grouped by labels, reading chunk_size rows at a time
+
+        Args:
+            images (np.ndarray or np.memmap): (N, 48, 48) image buffer
+            rows (np.ndarray): row positions into images
+            labels (np.ndarray): label of each row in rows
+            n_groups (int): number of classes
+            '''
+        stats = cls(n_groups, images.shape[1:])
+        for start in range(0, len(rows), chunk_size):
+            stop = start + chunk_size
+            stats.update(images[rows[start:stop]], labels[start:stop])
+        return stats
+
+    @property
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._sum / self.count[:, None]
+
+    @property
+    def var(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.maximum(self._sumsq / self.count[:, None] - np.square(self.mean), 0)
+
+    def total(self):
+        '''(count, mean) over all groups combined'''
+        count = self.count.sum()
+        return count, self._sum.sum(0) / count
+
+    def image(self, values):
+        # reshape per-feature stats back to image shape
+        return values.reshape(values.shape[:-1] + self.img_shape)
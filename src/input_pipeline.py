@@ -0,0 +1,128 @@
+import numpy as np
+import tensorflow as tf
+
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def preprocess(x, y):
+    '''
+    Same scaling as keras.applications.xception.preprocess_input ('tf' mode):
+    uint8 [0, 255] -> float32 [-1, 1]
+    '''
+    return tf.cast(x, tf.float32) / 127.5 - 1., y
+
+
+def to_float32(x, y):
+    # inputs that were preprocessed ahead of time and stored compactly (float16)
+    return tf.cast(x, tf.float32), y
+
+
+def preprocess_images(images, dtype='float16', chunk_size=4096, out=None):
+    '''
+    preprocess_input scaling of a whole uint8 image buffer, stored as dtype,
+    computed chunk_size rows at a time (for the preprocessed tensor cache)
+
+    out (np.ndarray): array to write into, e.g. a memory-mapped cache file
+    (CacheVariant.create), so the preprocessed buffer never has to fit in memory
+    '''
+    out = np.empty(images.shape, dtype=dtype) if out is None else out
+    for start in range(0, len(images), chunk_size):
+        chunk = np.asarray(images[start:start+chunk_size], dtype=np.float32)
+        out[start:start+chunk_size] = chunk / 127.5 - 1.
+    return out
+
+
+def gather_rows(x, y):
+    '''
+    tf.data map from a batch of positions to (x[positions], y[positions]),
+    read from x in place (a memmap or ImageView is never loaded whole)
+    '''
+    y = np.asarray(y)
+    def gather(positions):
+        return np.asarray(x[positions]), y[positions]
+    def fnc(positions):
+        x_batch, y_batch = tf.numpy_function(gather, [positions], (tf.as_dtype(x.dtype), tf.as_dtype(y.dtype)))
+        return tf.ensure_shape(x_batch, (None,) + tuple(x.shape[1:])), tf.ensure_shape(y_batch, (None,) + y.shape[1:])
+    return fnc
+
+
+def make_dataset(x, y, batch_size, shuffle=False, seed=None, repeat=False, cache=True, preprocess_fn=preprocess,
+                 on_batch=None):
+    '''
+    tf.data input pipeline replacing ImageDataGenerator(preprocess_input).flow
+
+    uint8 images go in, preprocessing runs as a parallel map, preprocessed
+    tensors are cached in memory after the first pass (so later epochs skip
+    preprocessing), and batches are prefetched while the model trains.
+
+    With cache=False nothing is held for the whole split: row positions are
+    shuffled and batched, each batch is read from x in place (gather_rows)
+    and preprocess_fn runs on the batch. Use it for inputs preprocessed
+    ahead of time (preprocess_fn=to_float32 for the float16 cache, None to
+    feed uint8 to a model that rescales in its first layer) and for single
+    passes such as evaluation.
+
+    Args:
+        x (array-like): (n, 48, 48, 1) uint8 images (np.ndarray or ImageView)
+        y (np.ndarray): labels, sparse or one-hot
+        batch_size (int): images per batch
+        shuffle (bool): reshuffle every epoch
+        seed (int): shuffle seed
+        repeat (bool): repeat forever (for fit with steps_per_epoch)
+        cache (bool): keep preprocessed tensors in memory after the first epoch
+        preprocess_fn (function): map applied to each (x, y) (to each batch if cache=False), None for no map
+        on_batch (function): map applied to each batch before prefetch
+            (e.g. telemetry.TrainingTelemetry.mark_ready)
+
+    Returns:
+        tf.data.Dataset of (x, y) batches
+        '''
+    if cache:
+        ds = tf.data.Dataset.from_tensor_slices((np.asarray(x), np.asarray(y)))
+        if preprocess_fn is not None:
+            ds = ds.map(preprocess_fn, num_parallel_calls=AUTOTUNE)
+        ds = ds.cache()
+        if shuffle:
+            ds = ds.shuffle(len(y), seed=seed, reshuffle_each_iteration=True)
+        ds = ds.batch(batch_size)
+    else:
+        ds = tf.data.Dataset.range(len(y))
+        if shuffle: # the shuffle buffer holds positions, not images
+            ds = ds.shuffle(len(y), seed=seed, reshuffle_each_iteration=True)
+        ds = ds.batch(batch_size).map(gather_rows(x, y), num_parallel_calls=AUTOTUNE)
+        if preprocess_fn is not None:
+            ds = ds.map(preprocess_fn, num_parallel_calls=AUTOTUNE)
+    if repeat:
+        ds = ds.repeat()
+    if on_batch is not None:
+        ds = ds.map(on_batch)
+    return ds.prefetch(AUTOTUNE)
+
+
+def make_balanced_dataset(x, y, sampler, preprocess_fn=preprocess, on_batch=None):
+    '''
+    Endless tf.data pipeline of class-balanced batches drawn on the fly
+
+    Each step the sampler's positions are read from x in place (gather_rows)
+    and preprocessed as a batch, so neither the split nor a balanced copy of
+    it is ever held in memory.
+
+    Args:
+        x (array-like): (n, 48, 48, 1) images (np.ndarray or ImageView)
+        y (np.ndarray): labels of the same rows, sparse or one-hot
+        sampler (splits.BalancedBatchSampler): positions of each batch (into x)
+        preprocess_fn (function): map applied to each (x, y) batch, None for no map
+        on_batch (function): map applied to each batch before prefetch
+
+    Returns:
+        tf.data.Dataset of (x, y) batches, repeating forever
+        '''
+    positions = tf.data.Dataset.from_generator(lambda: iter(sampler),
+                                               output_signature=tf.TensorSpec([None], tf.int64))
+    ds = positions.map(gather_rows(x, y), num_parallel_calls=AUTOTUNE)
+    if preprocess_fn is not None:
+        ds = ds.map(preprocess_fn, num_parallel_calls=AUTOTUNE)
+    if on_batch is not None:
+        ds = ds.map(on_batch)
+    return ds.prefetch(AUTOTUNE)
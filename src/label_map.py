@@ -0,0 +1,61 @@
+import numpy as np
+
+
+def build_label_map(emo_dict, spec):
+    '''
+    Build a lookup table that drops and/or merges classes
+
+    Remaining classes keep their original order and are renumbered from 0.
+    A merged class takes the position of its first member.
+
+    Args:
+        emo_dict (dict): current label -> class name, e.g. {0: 'Angry', ...}
+        spec (dict): 'drop': list of classes to remove,
+                     'merge': {new name: list of classes to combine}
+                     classes may be given by label or by name
+
+    Returns:
+        lut (np.ndarray): lut[old_label] = new label, or -1 if dropped
+        new_emo_dict (dict): new label -> class name
+        '''
+    names = {name: label for label, name in emo_dict.items()}
+    def to_label(cls):
+        if cls in emo_dict:
+            return cls
+        if cls in names:
+            return names[cls]
+        raise KeyError(f'Unknown class {cls!r}, expected one of {list(emo_dict.values())}')
+
+    dropped = {to_label(cls) for cls in spec.get('drop', [])}
+    merged_into = {} # old label -> merged class name
+    for new_name, members in spec.get('merge', {}).items():
+        for cls in members:
+            label = to_label(cls)
+            if label in dropped or label in merged_into:
+                raise ValueError(f'Class {emo_dict[label]!r} is dropped or merged more than once')
+            merged_into[label] = new_name
+
+    lut = np.full(max(emo_dict) + 1, -1, dtype=np.int64)
+    new_emo_dict = {}
+    new_labels = {} # new class name -> new label
+    for label in sorted(emo_dict):
+        if label in dropped:
+            continue
+        name = merged_into.get(label, emo_dict[label])
+        if name not in new_labels:
+            new_labels[name] = len(new_labels)
+            new_emo_dict[new_labels[name]] = name
+        lut[label] = new_labels[name]
+    return lut, new_emo_dict
+
+
+def apply_label_map(labels, lut):
+    '''
+    Remap labels with a table from build_label_map in one vectorized lookup
+
+    Returns:
+        new_labels (np.ndarray): remapped labels (-1 where dropped)
+        keep (np.ndarray): boolean mask of rows that were not dropped
+        '''
+    new_labels = lut[np.asarray(labels)]
+    return new_labels, new_labels >= 0
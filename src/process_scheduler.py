@@ -0,0 +1,53 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+
+
+THREAD_ENV_VARS = ['TF_NUM_INTRAOP_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+@contextmanager
+def thread_budget(intra_op, inter_op=1):
+    '''
+    Set thread counts in the environment while worker processes are spawned
+
+    TensorFlow (and BLAS) read these once at startup, before any code we
+    control runs in a spawned worker, so they have to be inherited from the
+    parent's environment rather than set inside the worker.
+    '''
+    budget = {name: str(intra_op) for name in THREAD_ENV_VARS}
+    budget['TF_NUM_INTEROP_THREADS'] = str(inter_op)
+    saved = {name: os.environ.get(name) for name in budget}
+    os.environ.update(budget)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def run_with_thread_budgets(fnc, jobs, n_workers=None, n_cores=None):
+    '''
+    Run fnc(*job) for every job in concurrent spawned processes, splitting
+    the cores between them (intra-op threads = cores // workers)
+
+    Args:
+        fnc (function): module-level function (picklable)
+        jobs (list of tuple): positional arguments for each call
+        n_workers (int): concurrent processes (None = one per job, at most one per core)
+        n_cores (int): cores to split (None = all)
+
+    Returns:
+        list: fnc results in the order of jobs
+        '''
+    n_cores = n_cores or os.cpu_count()
+    n_workers = min(n_workers or n_cores, len(jobs))
+    intra_op = max(1, n_cores // n_workers)
+    print(f'Running {len(jobs)} jobs on {n_workers} processes with {intra_op} threads each')
+    with thread_budget(intra_op), ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context('spawn')) as pool:
+        futures = [pool.submit(fnc, *job) for job in jobs]
+        return [future.result() for future in futures]
@@ -0,0 +1,180 @@
+import numpy as np
+
+
+LAYOUTS = ('image', 'flat', 'channels_last')
+
+
+class ImageView():
+    '''
+    Lazy, read-only view of images[idx] in one of three layouts:
+        'image'         (n, 48, 48)
+        'flat'          (n, 2304) for sklearn models
+        'channels_last' (n, 48, 48, 1) for keras models
+
+    Nothing is copied until rows are read. Indexing (view[i], view[a:b],
+    view[idx_array]) gathers just the requested rows, and np.asarray(view)
+    gathers all of them once. When idx is a contiguous run (e.g. FER2013's
+    Usage blocks) rows are sliced out of the shared buffer without any copy.
+    '''
+
+    def __init__(self, images, idx, layout='image'):
+        if layout not in LAYOUTS:
+            raise ValueError(f'layout must be one of {LAYOUTS}, got {layout!r}')
+        self.images = images # shared (N, 48, 48) buffer, typically a memmap
+        self.idx = np.asarray(idx, dtype=np.int64)
+        self.layout = layout
+        self._run = self._contiguous_run(self.idx)
+
+    @staticmethod
+    def _contiguous_run(idx):
+        # slice equivalent to idx if idx is start, start+1, ..., else None
+        if len(idx) and idx[-1] - idx[0] + 1 == len(idx) and np.all(np.diff(idx) == 1):
+            return slice(int(idx[0]), int(idx[-1]) + 1)
+        return None
+
+    @property
+    def shape(self):
+        return self._shape(len(self.idx))
+
+    def _shape(self, n):
+        img_shape = self.images.shape[1:]
+        if self.layout == 'flat':
+            return (n, int(np.prod(img_shape)))
+        if self.layout == 'channels_last':
+            return (n,) + img_shape + (1,)
+        return (n,) + img_shape
+
+    @property
+    def dtype(self):
+        return self.images.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return len(self.idx)
+
+    def with_layout(self, layout):
+        return ImageView(self.images, self.idx, layout)
+
+    def flat(self):
+        return self.with_layout('flat')
+
+    def channels_last(self):
+        return self.with_layout('channels_last')
+
+    def subset(self, positions):
+        # another lazy view over a subset of this view's rows
+        return ImageView(self.images, self.idx[positions], self.layout)
+
+    def _gather(self, key):
+        if self._run is not None and isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(len(self.idx))
+            rows = self.images[self._run][start:stop] # view, no copy
+        else:
+            rows = self.images[self.idx[key]]
+        return rows
+
+    def __getitem__(self, key):
+        if np.isscalar(key):
+            return self[[key]][0]
+        rows = self._gather(key)
+        return rows.reshape(self._shape(len(rows)))
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype, copy=False)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def usage_indices(df, usage):
+    # row positions (into the image buffer) of df rows with the given Usage
+    return df.index.values[(df['Usage'] == usage).values]
+
+
+def balanced_positions(labels, seed):
+    '''
+    Downsample a split so every class has as many rows as the smallest class
+
+    Args:
+        labels (np.ndarray): labels of the split's rows
+        seed (int): random seed for the per-class draw
+
+    Returns:
+        np.ndarray: sorted positions (into labels) of the balanced subset
+        '''
+    rng = np.random.RandomState(seed)
+    classes, counts = np.unique(labels, return_counts=True)
+    n_min = counts.min()
+    picks = [rng.choice(np.flatnonzero(labels == c), n_min, replace=False) for c in classes]
+    return np.sort(np.concatenate(picks))
+
+
+class BalancedBatchSampler():
+    '''
+    Class-balanced batches of positions into a split, drawn on the fly
+
+    Every batch takes an equal share of each class (the remainder of
+    batch_size goes to randomly chosen classes). Within a class positions
+    are drawn from a reshuffled permutation, cycling, so the large classes
+    are seen in full over time instead of being downsampled once, and the
+    small classes are repeated. Only per-class index arrays are held.
+    '''
+
+    def __init__(self, labels, batch_size, seed=None):
+        '''
+        Args:
+            labels (np.ndarray): labels of the split's rows
+            batch_size (int): positions per batch
+            seed (int): random seed
+            '''
+        self.labels = np.asarray(labels)
+        self.batch_size = batch_size
+        self.rng = np.random.RandomState(seed)
+        self.classes, self.counts = np.unique(self.labels, return_counts=True)
+        self._members = [np.flatnonzero(self.labels == c) for c in self.classes]
+        self._order = [self.rng.permutation(m) for m in self._members]
+        self._next = np.zeros(len(self.classes), dtype=np.int64)
+
+    def _draw(self, k, n):
+        # next n positions of class k, reshuffling whenever its permutation runs out
+        out = []
+        while n > 0:
+            if self._next[k] == len(self._order[k]):
+                self._order[k] = self.rng.permutation(self._members[k])
+                self._next[k] = 0
+            take = min(n, len(self._order[k]) - self._next[k])
+            out.append(self._order[k][self._next[k]:self._next[k]+take])
+            self._next[k] += take
+            n -= take
+        return out
+
+    def batch(self):
+        '''Positions (into labels) of the next balanced batch, shuffled'''
+        per_class = np.full(len(self.classes), self.batch_size // len(self.classes))
+        extra = self.rng.choice(len(self.classes), self.batch_size % len(self.classes), replace=False)
+        per_class[extra] += 1
+        positions = np.concatenate([p for k, n in enumerate(per_class) for p in self._draw(k, n)])
+        return positions[self.rng.permutation(len(positions))]
+
+    def __iter__(self):
+        while True:
+            yield self.batch()
+
+    def class_draws(self, n_samples=None):
+        '''Expected draws per class in n_samples (default: one pass of the split)'''
+        n_samples = len(self.labels) if n_samples is None else n_samples
+        return np.full(len(self.classes), n_samples / len(self.classes)) # aligned with self.classes
+
+    def sample_weight(self):
+        '''
+        Expected draws per row in one pass of the split, for estimators that
+        take sample_weight: each class carries the same total weight and the
+        weights sum to the number of rows
+        '''
+        weight = len(self.labels) / (len(self.classes) * self.counts)
+        return weight[np.searchsorted(self.classes, self.labels)]
@@ -0,0 +1,176 @@
+import os
+import time
+import json
+import pickle
+import shutil
+from dataset_cache import hash_params
+
+
+class Stage():
+    '''One step of an analysis (see StageGraph.add)'''
+
+    def __init__(self, name, fnc, deps=(), params=None, cache=True, group=None, files=()):
+        self.name = name
+        self.fnc = fnc
+        self.deps = list(deps)
+        self.params = params
+        self.cache = cache
+        self.group = group
+        self.files = list(files)
+
+    def get_params(self):
+        return self.params() if callable(self.params) else (self.params or {})
+
+
+class StageGraph():
+    '''
+    Dependency graph of analysis stages with per-stage output caching
+
+    A stage's key hashes its name, its parameters and the keys of the stages
+    it depends on, so changing a parameter invalidates that stage and
+    everything downstream of it and nothing else. Cached stages store what
+    fnc returned and copies of the files they write under
+
+        root/<stage name>/<key>/  outputs.pkl, params.json, files/
+
+    On a rerun a cached stage with an unchanged key is restored (outputs
+    handed to apply, files copied back) instead of executed. Stages with
+    cache=False (cheap setup, e.g. opening memory-mapped data) only run when
+    something that has to execute depends on them.
+
+    Stages in the same group that need to run are executed together by the
+    group's runner, so a group can fan its members out over processes.
+    '''
+
+    def __init__(self, root, apply=None):
+        self.root = root
+        self.apply = apply # apply(name, outputs) for every stage output, run or restored, in stage order
+        self.stages = {} # in insertion order, which has to be a topological order
+        self.groups = {}
+        self._keys = {}
+
+    def add(self, name, fnc, deps=(), params=None, cache=True, group=None, files=()):
+        '''
+        Args:
+            name (str): stage name
+            fnc (function): fnc() -> outputs (picklable, or None), or for a
+                grouped stage None (the group runner executes it)
+            deps (list of str): stages that have to be complete first (added earlier)
+            params (dict or function): json-able inputs of the stage, a
+                function is only called when the key is needed
+            cache (bool): store outputs and restore them on unchanged inputs
+            group (str): executed with its group's runner (see add_group)
+            files (list of str): files the stage writes, cached with its outputs
+            '''
+        missing = [d for d in deps if d not in self.stages]
+        if missing:
+            raise ValueError(f'Stage {name} depends on unknown stages {missing}')
+        self.stages[name] = Stage(name, fnc, deps, params, cache, group, files)
+
+    def add_group(self, group, runner):
+        # runner(names) -> {name: outputs} for the members of group that need to run
+        self.groups[group] = runner
+
+    def key(self, name):
+        if name not in self._keys:
+            stage = self.stages[name]
+            self._keys[name] = hash_params({'stage': name,
+                                            'params': stage.get_params(),
+                                            'deps': [self.key(d) for d in stage.deps]})
+        return self._keys[name]
+
+    def path(self, name):
+        return os.path.join(self.root, name, self.key(name))
+
+    def is_cached(self, name):
+        return self.stages[name].cache and os.path.isfile(os.path.join(self.path(name), 'outputs.pkl'))
+
+    def ancestors(self, names):
+        '''names and every stage they depend on'''
+        found, todo = set(), list(names)
+        while todo:
+            name = todo.pop()
+            if name not in found:
+                found.add(name)
+                todo.extend(self.stages[name].deps)
+        return found
+
+    def status(self):
+        '''(name, key, cached) for every stage'''
+        self._keys = {}
+        return [(name, self.key(name), self.is_cached(name)) for name in self.stages]
+
+    def run(self, targets=None, force=()):
+        '''
+        Bring targets (default: every stage) up to date
+
+        Args:
+            targets (list of str): stages wanted, with whatever they depend on
+            force (list of str): stages executed even if cached
+
+        Returns:
+            dict: outputs by stage name, for the stages executed or restored
+            '''
+        self._keys = {} # params may have changed since the last run
+        targets = list(self.stages) if targets is None else list(targets)
+        needed = self.ancestors(targets)
+        order = [name for name in self.stages if name in needed]
+        stale = {name for name in order if name in force or not self.is_cached(name)}
+        # stale targets run, and so do the stale stages they (transitively) depend on
+        to_run = {name for name in targets if name in stale}
+        for name in reversed(order):
+            if name in to_run:
+                to_run.update(d for d in self.stages[name].deps if d in stale)
+        outputs, done = {}, set()
+        for name in order:
+            stage = self.stages[name]
+            if name in to_run and name not in outputs:
+                if stage.group is None:
+                    outputs.update(self.execute([name], lambda names: {name: stage.fnc()}))
+                else: # every member of the group that is ready runs together
+                    batch = [n for n in order if n in to_run and n not in outputs
+                             and self.stages[n].group == stage.group
+                             and all(d in done for d in self.stages[n].deps)]
+                    outputs.update(self.execute(batch, self.groups[stage.group]))
+            elif name not in to_run and stage.cache:
+                outputs[name] = self.load(name)
+                print(f'Stage {name}: restored from cache ({self.key(name)})')
+            if self.apply is not None and outputs.get(name) is not None:
+                self.apply(name, outputs[name])
+            done.add(name)
+        return outputs
+
+    def execute(self, names, runner):
+        start = time.perf_counter()
+        print(f'Running stages: {names}')
+        results = runner(names)
+        print(f'Stages {names} took {time.perf_counter() - start:.1f}s')
+        for name in names:
+            self.save(name, results.get(name))
+        return results
+
+    def save(self, name, outputs):
+        stage = self.stages[name]
+        if not stage.cache:
+            return
+        path = self.path(name)
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(os.path.join(tmp_path, 'files'))
+        for fname in stage.files:
+            shutil.copy2(fname, os.path.join(tmp_path, 'files', os.path.basename(fname)))
+        with open(os.path.join(tmp_path, 'params.json'), 'w') as f:
+            json.dump(stage.get_params(), f, sort_keys=True, default=str)
+        with open(os.path.join(tmp_path, 'outputs.pkl'), 'wb') as f:
+            pickle.dump(outputs, f)
+        shutil.rmtree(path, ignore_errors=True) # a forced rerun replaces the entry
+        os.replace(tmp_path, path)
+
+    def load(self, name):
+        path = self.path(name)
+        for fname in self.stages[name].files:
+            if os.path.dirname(fname):
+                os.makedirs(os.path.dirname(fname), exist_ok=True)
+            shutil.copy2(os.path.join(path, 'files', os.path.basename(fname)), fname)
+        with open(os.path.join(path, 'outputs.pkl'), 'rb') as f:
+            return pickle.load(f)
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from keras.callbacks import Callback
+
+
+class TrainingTelemetry(Callback):
+    '''
+    Per-epoch training throughput written to json and csv as each epoch ends
+
+    Records samples/sec, step time (mean, median, max) and input stall: how
+    long steps waited for their batch. Stall is measured by stamping each
+    batch as the input pipeline finishes it (mark_ready, mapped over the
+    training dataset before prefetch by make_dataset(on_batch=...)) and
+    comparing with the time the step that consumes it began; a batch that
+    was already prefetched costs no stall.
+
+    The overhead is a few timestamps per step and one small file write per
+    epoch, so it can stay on for every run.
+    '''
+
+    def __init__(self, log_dir):
+        super().__init__()
+        self.log_dir = log_dir
+        self.history = [] # one dict per epoch
+        self._ready = [] # (time, batch size) of each training batch produced, in production order
+        self._consumed = 0 # training batches consumed so far (index into _ready)
+
+    def mark_ready(self, x, y):
+        # tf.data map: stamp the batch as produced, pass it through unchanged
+        stamp = tf.py_function(self._stamp, [tf.shape(x)[0]], tf.float64)
+        with tf.control_dependencies([stamp]):
+            return tf.identity(x), y
+
+    def _stamp(self, n_samples):
+        now = time.perf_counter()
+        self._ready.append((now, int(n_samples)))
+        return now
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._begin, self._end, self._stall = [], [], []
+        self._samples = 0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        now = time.perf_counter()
+        self._begin.append(now)
+        self._batch_index = self._consumed
+        self._consumed += 1
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._end.append(time.perf_counter())
+        # the batch is produced while the step runs when the pipeline falls behind
+        if self._batch_index < len(self._ready):
+            ready, n_samples = self._ready[self._batch_index]
+            self._stall.append(max(0., ready - self._begin[-1]))
+            self._samples += n_samples
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_end = time.perf_counter()
+        steps = np.array(self._end) - np.array(self._begin)
+        train_seconds = self._end[-1] - self._begin[0]
+        row = {'epoch': epoch,
+               'steps': len(steps),
+               'samples': self._samples,
+               'samples_per_sec': self._samples / train_seconds,
+               'train_seconds': train_seconds,
+               'validation_seconds': epoch_end - self._end[-1],
+               'step_ms_mean': 1000 * steps.mean(),
+               'step_ms_median': 1000 * np.median(steps),
+               'step_ms_max': 1000 * steps.max(),
+               'input_stall_seconds': sum(self._stall),
+               'input_stall_fraction': sum(self._stall) / train_seconds}
+        row.update({k: float(v) for k, v in (logs or {}).items()})
+        self.history.append(row)
+        self.write()
+
+    def write(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        with open(os.path.join(self.log_dir, 'telemetry.json'), 'w') as f:
+            json.dump(self.history, f, indent=1)
+        pd.DataFrame(self.history).to_csv(os.path.join(self.log_dir, 'telemetry.csv'), index=False)
+
+
+class GradientHistograms(Callback):
+    '''
+    Gradient histograms for TensorBoard, which TF2's TensorBoard callback no
+    longer writes (write_grads is ignored)
+
+    Every `every` epochs (the TensorBoard histogram_freq schedule) the loss
+    gradients of one fixed batch are written to log_dir/gradients as
+    tf.summary histograms, one per trainable variable.
+    '''
+
+    def __init__(self, log_dir, dataset, every=10):
+        super().__init__()
+        self.log_dir = log_dir
+        self.dataset = dataset # (x, y) batches, the first one is used (e.g. the validation dataset)
+        self.every = every
+
+    def on_train_begin(self, logs=None):
+        self._x, self._y = next(iter(self.dataset))
+        self._writer = tf.summary.create_file_writer(os.path.join(self.log_dir, 'gradients'))
+
+    def on_epoch_end(self, epoch, logs=None):
+        if epoch % self.every:
+            return
+        with tf.GradientTape() as tape:
+            loss = self.model.compute_loss(self._x, self._y, self.model(self._x, training=False))
+        variables = self.model.trainable_variables
+        with self._writer.as_default():
+            for variable, grad in zip(variables, tape.gradient(loss, variables)):
+                tf.summary.histogram(variable.name.replace(':', '_') + '/gradient', grad, step=epoch)
+        self._writer.flush()
@@ -0,0 +1,168 @@
+import time
+import queue
+import threading
+import cv2
+import numpy as np
+
+
+_DONE = object() # end-of-stream marker passed down the queues
+
+
+class VideoPipeline():
+    '''
+    Pipelined video classification: decode -> detect -> classify -> sink
+
+        decoder thread      VideoCapture.read, frames numbered in order
+        detection workers   BGR->gray, Haar cascade, face crops (own cascade each)
+        classifier thread   crops from any frames batched into one forward pass
+                            (up to batch_size faces or max_latency seconds)
+        sink (caller)       results put back in frame order
+
+    Stages are connected by bounded queues, so a slow stage blocks the ones
+    before it (backpressure) instead of frames piling up in memory. The
+    reorder buffer in the sink holds at most the frames in flight.
+    '''
+
+    def __init__(self, predictor, n_detectors=2, queue_size=8, batch_size=32, max_latency=0.05, write_imgs=False):
+        '''
+        Args:
+            predictor (EmotionFacePredictor): set up predictor (model and cascade file)
+            n_detectors (int): detection worker threads
+            queue_size (int): capacity of each queue between stages
+            batch_size (int): faces per forward pass
+            max_latency (float): seconds a frame may wait for its batch to fill
+            write_imgs (bool): write face crops to faces/ (as read_frame)
+            '''
+        self.predictor = predictor
+        self.n_detectors = n_detectors
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.write_imgs = write_imgs
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.detections = queue.Queue(maxsize=queue_size)
+        self.results = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.error = None
+
+    def _put(self, q, item):
+        # blocking put that gives up when the pipeline is stopped (so no thread hangs on a full queue)
+        while not self.stopping.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q, timeout=None):
+        try:
+            return q.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _guard(self, fnc, *args):
+        # run a stage, recording its error and stopping the pipeline if it fails
+        try:
+            fnc(*args)
+        except Exception as e:
+            self.error = e
+            self.stopping.set()
+
+    def decode(self, vc):
+        idx = 0
+        while not self.stopping.is_set():
+            ret, frame = vc.read()
+            if not ret:
+                break
+            if not self._put(self.frames, (idx, frame)):
+                return
+            idx += 1
+        for _ in range(self.n_detectors):
+            self._put(self.frames, _DONE)
+
+    def detect(self):
+        cascade = cv2.CascadeClassifier(self.predictor.cascade_file) # cascades are not shared between threads
+        detect_faces = self.predictor.frame_detector(cascade)
+        size = self.predictor.face_size
+        while True:
+            item = self._get(self.frames, timeout=0.1)
+            if item is _DONE or self.stopping.is_set():
+                break
+            if item is None:
+                continue
+            idx, frame = item
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            faces = detect_faces(gray)
+            print(f'Found {len(faces)} faces')
+            crops = np.empty((len(faces), size[0], size[1], 1), dtype=np.uint8)
+            if len(faces)>0:
+                crop_files = ["faces/face_" + str(y) + ".jpg" for (x, y, w, h) in faces] if self.write_imgs else None
+                self.predictor.crop_faces(frame, faces, color=True, crop_files=crop_files, out=crops)
+            if not self._put(self.detections, (idx, frame, crops)):
+                return
+        self._put(self.detections, _DONE)
+
+    def classify(self):
+        waiting = [] # (idx, frame, crops) of frames in the current batch
+        n_faces, since, n_done = 0, None, 0
+        while n_done < self.n_detectors and not self.stopping.is_set():
+            item = self._get(self.detections, timeout=0.005 if waiting else 0.1) # poll the deadline while waiting
+            if item is _DONE:
+                n_done += 1
+            elif item is not None:
+                waiting.append(item)
+                n_faces += len(item[2])
+                since = since or time.time()
+            if waiting and (n_faces >= self.batch_size or n_done == self.n_detectors
+                            or time.time() - since >= self.max_latency):
+                self.flush(waiting, n_faces)
+                waiting, n_faces, since = [], 0, None
+        self._put(self.results, _DONE)
+
+    def flush(self, waiting, n_faces):
+        # one forward pass for every face waiting, results split back per frame
+        if n_faces:
+            predicts, probas = self.predictor.predict_batch(np.concatenate([crops for _, _, crops in waiting]))
+            self.predictor.print_predictions(predicts, probas)
+        start = 0
+        for idx, frame, crops in waiting:
+            n = len(crops)
+            if n:
+                result = ([probas[i:i+1] for i in range(start, start+n)], list(predicts[start:start+n]))
+            else:
+                result = self.predictor.no_face_result()
+            start += n
+            if not self._put(self.results, (idx, frame, result)):
+                return
+
+    def run(self, vc):
+        '''
+        Generator of (frame, (probas, predicts)) in frame order, with
+        (probas, predicts) as read_frame returns them. Closing the generator
+        early (break + close()) stops the threads.
+        '''
+        threads = [threading.Thread(target=self._guard, args=(self.decode, vc), daemon=True)]
+        threads += [threading.Thread(target=self._guard, args=(self.detect,), daemon=True)
+                    for _ in range(self.n_detectors)]
+        threads.append(threading.Thread(target=self._guard, args=(self.classify,), daemon=True))
+        for thread in threads:
+            thread.start()
+        reorder, next_idx = {}, 0
+        try:
+            while True:
+                item = self._get(self.results, timeout=0.1)
+                if item is _DONE or (item is None and self.stopping.is_set()):
+                    break
+                if item is None:
+                    continue
+                idx, frame, result = item
+                reorder[idx] = (frame, result)
+                while next_idx in reorder:
+                    yield reorder.pop(next_idx)
+                    next_idx += 1
+        finally:
+            self.stopping.set()
+            for thread in threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error
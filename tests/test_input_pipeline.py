@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from keras.applications.xception import preprocess_input
+from keras.preprocessing.image import ImageDataGenerator
+from input_pipeline import make_dataset
+
+
+@pytest.fixture
+def fer_like():
+    rng = np.random.RandomState(0)
+    x = rng.randint(0, 256, size=(300, 48, 48, 1)).astype(np.uint8)
+    y = rng.randint(0, 7, size=300)
+    return x, y
+
+
+def test_make_dataset_matches_image_data_generator(fer_like):
+    # same batches as ImageDataGenerator(preprocess_input).flow, unshuffled (including the short last batch)
+    x, y = fer_like
+    flow = ImageDataGenerator(preprocessing_function=preprocess_input).flow(x, y, batch_size=64, shuffle=False)
+    batches = list(make_dataset(x, y, 64))
+    assert len(batches) == len(flow)
+    for i, (new_x, new_y) in enumerate(batches):
+        ref_x, ref_y = flow[i]
+        np.testing.assert_allclose(new_x.numpy(), ref_x, atol=1e-6)
+        np.testing.assert_array_equal(new_y.numpy(), ref_y)
+
+
+def test_make_dataset_shuffle_is_a_permutation(fer_like):
+    # a shuffled epoch still holds every (image, label) pair exactly once
+    x, y = fer_like
+    batches = list(make_dataset(x, y, 64, shuffle=True, seed=1, preprocess_fn=None, cache=False))
+    new_x = np.concatenate([b[0].numpy() for b in batches])
+    new_y = np.concatenate([b[1].numpy() for b in batches])
+    assert sorted(zip(map(bytes, new_x), new_y)) == sorted(zip(map(bytes, x), y))
+
+
+def test_streamed_batches_match_cached(fer_like, tmp_path):
+    # cache=False reads batches from a memmapped ImageView in place, with the same contents as the cached path
+    from splits import ImageView
+    x, y = fer_like
+    images = np.lib.format.open_memmap(str(tmp_path / 'images.npy'), mode='w+', dtype=np.uint8, shape=x.shape[:3])
+    images[:] = x[..., 0]
+    idx = np.arange(10, 290, 2)
+    view = ImageView(images, idx, 'channels_last')
+    streamed = list(make_dataset(view, y[idx], 32, cache=False))
+    cached = list(make_dataset(x[idx], y[idx], 32))
+    assert len(streamed) == len(cached)
+    for (new_x, new_y), (ref_x, ref_y) in zip(streamed, cached):
+        assert new_x.dtype == ref_x.dtype
+        np.testing.assert_array_equal(new_x.numpy(), ref_x.numpy())
+        np.testing.assert_array_equal(new_y.numpy(), ref_y.numpy())